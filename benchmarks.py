@@ -0,0 +1,168 @@
+"""
+Micro-benchmarks — `python benchmarks.py <nome> [-n N]`.
+Imprimem um JSON por benchmark, para comparar entre commits.
+"""
+import argparse
+import json
+import statistics
+import time
+
+
+def _measure(fn, n: int) -> dict:
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {
+        "n": n,
+        "mean_us": round(statistics.fmean(samples), 2),
+        "p50_us": round(samples[len(samples) // 2], 2),
+        "p99_us": round(samples[int(len(samples) * 0.99) - 1], 2),
+    }
+
+
+def _sample_session():
+    from menu import get_catalog
+    from session import CallSession
+    session = CallSession("CA-bench", "+5511999990000")
+    for item_id in ("BURGER-001", "BURGER-004", "SIDE-001", "SIDE-004", "SAUCE-003", "DRINK-004"):
+        item = get_catalog().items[item_id]
+        session.add_item(item_id, item["name_pt"], 2, item["price"])
+    return session
+
+
+def bench_comanda(n: int) -> dict:
+    """Lista de comandos + chamadas p.text/p.set vs. buffer ESC/POS único."""
+    from escpos.printer import Dummy
+    from comanda import build_comanda_text, _print_commands, render_comanda_bytes
+
+    session = _sample_session()
+
+    class CountingDummy(Dummy):
+        writes = 0
+
+        def _raw(self, msg):
+            CountingDummy.writes += 1
+            super()._raw(msg)
+
+    def legacy():
+        _print_commands(CountingDummy(), build_comanda_text(session))
+
+    def compiled():
+        CountingDummy()._raw(render_comanda_bytes(session))
+
+    CountingDummy.writes = 0
+    legacy()
+    legacy_writes = CountingDummy.writes
+    CountingDummy.writes = 0
+    compiled()
+    compiled_writes = CountingDummy.writes
+
+    return {
+        "legacy": {**_measure(legacy, n), "device_writes": legacy_writes},
+        "compiled": {**_measure(compiled, n), "device_writes": compiled_writes},
+        "ticket_bytes": len(render_comanda_bytes(session)),
+    }
+
+
+def _synthetic_menu(base: dict, size: int) -> dict:
+    """Replica os itens do menu.json com IDs/nomes novos até `size` itens."""
+    originals = [(c["name_pt"], i) for c in base["categories"] for i in c["items"]]
+    categories: dict[str, list] = {}
+    for n in range(size):
+        cat_name, item = originals[n % len(originals)]
+        copy = dict(item, id=f"{item['id']}-{n}", name_pt=f"{item['name_pt']} {n // len(originals) + 1}")
+        categories.setdefault(cat_name, []).append(copy)
+    return {
+        "restaurant": base["restaurant"],
+        "categories": [{"name_pt": name, "items": items} for name, items in categories.items()],
+    }
+
+
+def bench_menu_retrieval(n: int) -> dict:
+    """Tokens de prompt (cardápio completo vs. compacto + detalhes) e custo da busca por tamanho de menu."""
+    from menu import MenuCatalog, get_catalog
+    from prompt import estimate_tokens
+
+    transcripts = [
+        "quero um filti onion e uma coca zero",
+        "o que vem no guaca filthy",
+        "tem batata doce?",
+        "me vê duas onion rings com molho barbecue",
+    ]
+    results = []
+    for size in (19, 100, 500, 2000):
+        catalog = MenuCatalog(_synthetic_menu(get_catalog().data, size), f"bench-{size}")
+        retrieval_tokens = [
+            estimate_tokens(catalog.compact_text) + estimate_tokens(catalog.relevant_details(t, [], 6))
+            for t in transcripts
+        ]
+        timing = _measure(lambda: [catalog.relevant_details(t, [], 6) for t in transcripts], max(n // 10, 10))
+        results.append({
+            "menu_items": size,
+            "full_prompt_tokens": estimate_tokens(catalog.prompt_text),
+            "retrieval_prompt_tokens": round(statistics.fmean(retrieval_tokens)),
+            "retrieval_us_per_turn": round(timing["mean_us"] / len(transcripts), 2),
+        })
+    return {"sizes": results}
+
+
+def bench_journal(n: int) -> dict:
+    """Diário de pedidos: custo do record() no event loop e eventos/s gravados, group commit vs. commit por evento."""
+    import os
+    import sqlite3
+    import tempfile
+    from journal import OrderJournal, _INSERT, _SCHEMA
+
+    session = _sample_session()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for synchronous in ("NORMAL", "FULL"):
+            journal = OrderJournal(os.path.join(directory, f"group-{synchronous}.db"), synchronous=synchronous)
+            journal.start()
+            start = time.perf_counter()
+            enqueue = _measure(lambda: journal.items_changed(session), n)
+            journal.stop(timeout=60)
+            elapsed = time.perf_counter() - start
+            results[f"group_commit_{synchronous.lower()}"] = {
+                "record": enqueue,
+                "events_per_s": round(journal.written / elapsed),
+                "avg_batch": journal.stats()["avg_batch"],
+            }
+
+            # Referência: um INSERT + commit por evento, como seria gravando direto.
+            db = sqlite3.connect(os.path.join(directory, f"single-{synchronous}.db"))
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(f"PRAGMA synchronous={synchronous}")
+            db.executescript(_SCHEMA)
+            row = (time.time(), "2024-01-01", session.order_id, session.call_sid, "items", "{}")
+
+            def single():
+                with db:
+                    db.execute(_INSERT, row)
+
+            timing = _measure(single, max(n // 10, 10))
+            db.close()
+            results[f"per_event_commit_{synchronous.lower()}"] = {
+                **timing,
+                "events_per_s": round(1e6 / timing["mean_us"]),
+            }
+    return results
+
+
+BENCHMARKS = {
+    "comanda": bench_comanda,
+    "menu_retrieval": bench_menu_retrieval,
+    "journal": bench_journal,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("names", nargs="*", default=list(BENCHMARKS))
+    parser.add_argument("-n", type=int, default=2000)
+    args = parser.parse_args()
+    for name in args.names:
+        print(json.dumps({"benchmark": name, **BENCHMARKS[name](args.n)}))
@@ -8,10 +8,20 @@ Supports thermal printers via:
 Compatible: Epson TM-T20, and any generic ESC/POS printer.
 """
 import asyncio
+import fcntl
 import logging
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
 from datetime import datetime
+from functools import lru_cache
 from config import get_settings
+from menu import get_catalog, get_menu_version, get_restaurant_info
 from session import CallSession
+from journal import journal
+from metrics import observe_span, span
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
@@ -26,7 +36,6 @@ def _divider(char: str = "-", width: int = 42) -> str:
 
 
 def build_comanda_text(session: CallSession) -> list[dict]:
-    from menu import get_restaurant_info
     restaurant = get_restaurant_info()
     now = datetime.now()
     commands = []
@@ -98,65 +107,473 @@ def build_comanda_text(session: CallSession) -> list[dict]:
     return commands
 
 
-async def print_comanda(session: CallSession) -> bool:
-    try:
-        result = await asyncio.get_event_loop().run_in_executor(
-            None, _print_sync, session
+# ESC/POS control codes, written inline by render_comanda_bytes.
+ESC_INIT = b"\x1b@"
+ESC_CODEPAGE_CP850 = b"\x1bt\x02"
+ESC_BOLD_ON = b"\x1bE\x01"
+ESC_BOLD_OFF = b"\x1bE\x00"
+ESC_ALIGN_LEFT = b"\x1ba\x00"
+ESC_ALIGN_CENTER = b"\x1ba\x01"
+ESC_FEED_6 = b"\x1bd\x06"
+GS_FULL_CUT = b"\x1dV\x00"
+
+
+def _line(text: str = "") -> bytes:
+    return (text + "\n").encode("cp850", errors="replace")
+
+
+def _price_line(label: str, value: str) -> str:
+    spaces = 42 - len(label) - len(value)
+    return label + (" " * max(1, spaces)) + value
+
+
+@lru_cache(maxsize=4)
+def _ticket_frame(menu_version: str) -> tuple[bytes, bytes]:
+    """Static header/footer bytes, cached per menu version."""
+    restaurant = get_catalog().restaurant
+    prep = restaurant.get("prep_time_minutes", 20)
+
+    header = b"".join([
+        ESC_INIT, ESC_CODEPAGE_CP850,
+        ESC_ALIGN_CENTER, ESC_BOLD_ON, _line(restaurant["name"].upper()), ESC_BOLD_OFF,
+        _line(), _line(_center("═══ COMANDA ═══")), _line(),
+        ESC_ALIGN_LEFT, ESC_BOLD_ON, _line("Pedido N°:"), ESC_BOLD_OFF,
+    ])
+    footer = b"".join([
+        _line(), _line(_divider()),
+        ESC_ALIGN_CENTER, ESC_BOLD_ON, _line("✓ PAGO"), ESC_BOLD_OFF, _line(),
+        _line(f"Pronto em aprox. {prep} minutes"), _line("Retire no balcão"), _line(),
+        _line(_divider("═")), _line(_center("Obrigado!")), _line(_divider("═")),
+        _line(), _line(), b"\n" * 4,
+        ESC_FEED_6, GS_FULL_CUT,
+    ])
+    return header, footer
+
+
+def render_comanda_bytes(session: CallSession, items: list | None = None, station: str | None = None) -> bytes:
+    """The whole ticket as one cp850 ESC/POS buffer, sent in a single write.
+    With `items`/`station`, renders only that station's share of the order."""
+    header, footer = _ticket_frame(get_menu_version())
+    now = datetime.now()
+
+    buf = bytearray(header)
+    buf += _line(f"  #{session.order_id}")
+    buf += _line()
+    if station:
+        buf += ESC_BOLD_ON + _line(f"Estação: {station.upper()}") + ESC_BOLD_OFF
+        buf += _line()
+    buf += _line(f"Data/Hora: {now.strftime('%d/%m/%Y %H:%M:%S')}")
+    buf += _line(f"Telefone:     {session.from_number}")
+    buf += _line()
+    buf += _line(_divider())
+    buf += ESC_BOLD_ON + _line("ITENS DO PEDIDO:") + ESC_BOLD_OFF
+    buf += _line()
+    for item in (session.order_items if items is None else items):
+        buf += _line(_price_line(f"  {item.quantity}x {item.name}", f"R$ {item.total:.2f}"))
+    buf += _line()
+    buf += _line(_divider())
+    buf += ESC_BOLD_ON + _line(_price_line("TOTAL:", f"R$ {session.order_total:.2f}")) + ESC_BOLD_OFF
+    buf += footer
+    return bytes(buf)
+
+
+def _printer_config_from_settings() -> dict:
+    return {
+        "type": settings.printer_type,
+        "host": settings.printer_host,
+        "port": settings.printer_port,
+        "usb_vendor": settings.printer_usb_vendor,
+        "usb_product": settings.printer_usb_product,
+        "serial_port": settings.printer_serial_port,
+        "serial_baud": settings.printer_serial_baud,
+    }
+
+
+def _open_printer(config: dict):
+    from escpos.printer import Network, Usb, Serial, Dummy
+
+    printer_type = config["type"].lower()
+    if printer_type == "network":
+        p = Network(config["host"], port=config["port"], timeout=5)
+    elif printer_type == "usb":
+        p = Usb(
+            idVendor=int(config["usb_vendor"], 16),
+            idProduct=int(config["usb_product"], 16),
         )
-        return result
-    except Exception as e:
-        logger.error(f"[Printer] Failed to print comanda for order {session.order_id}: {e}")
+    elif printer_type == "serial":
+        p = Serial(devfile=config["serial_port"], baudrate=config["serial_baud"])
+    elif printer_type == "dummy":
+        p = Dummy()
+    else:
+        raise ValueError(f"Unknown printer type: {printer_type}")
+    if hasattr(p, "open") and printer_type != "dummy":
+        p.open()
+    return p
+
+
+def _print_commands(p, commands: list[dict]):
+    for cmd in commands:
+        ctype = cmd["type"]
+        value = cmd.get("value")
+        if ctype == "text":
+            p.text((value or "") + "\n")
+        elif ctype == "bold_on":
+            p.set(bold=True)
+        elif ctype == "bold_off":
+            p.set(bold=False)
+        elif ctype == "align":
+            p.set(align=value)
+        elif ctype == "feed":
+            p.ln(value or 1)
+        elif ctype == "cut":
+            p.cut()
+
+
+class PrinterSpool:
+    """
+    One writer thread per printer. The device connection stays open between
+    tickets and is reopened on error or failed health check. Every ticket is
+    written to disk before it is queued and removed only after it printed, so
+    a printer outage or a restart never loses a ticket.
+
+    With several web workers only one process owns the spool (see
+    start_spools); the others just drop ticket files in the directory and
+    the owner picks them up on its next scan.
+    """
+
+    def __init__(self, name: str, config: dict, spool_dir: str, on_printed=None, on_failed=None):
+        self.name = name
+        self.config = config
+        self.on_printed = on_printed
+        self.on_failed = on_failed
+        self.directory = os.path.join(spool_dir, name)
+        self._queue: queue.Queue = queue.Queue()
+        self._known: set[str] = set()  # paths already queued (owner only)
+        self.owner = False
+        self._thread: threading.Thread | None = None
+        self._printer = None
+        self._last_used = 0.0
+        self._stopping = False
+        self.printed = 0
+        self.failed_attempts = 0
+        self.reconnects = 0
+        self.latencies: deque[float] = deque(maxlen=200)
+
+    def start(self, owner: bool = True):
+        os.makedirs(self.directory, exist_ok=True)
+        self.owner = owner
+        if not owner:
+            return
+        pending = self._scan()
+        if pending:
+            logger.info("[Printer:%s] Recovered %s spooled tickets", self.name, pending)
+        self._thread = threading.Thread(target=self._run, name=f"printer-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stopping = True
+        self._queue.put(None)
+        if self._thread:
+            self._thread.join(timeout)
+        self._close()
+
+    def submit(self, order_id: str, payload: bytes) -> str:
+        """Blocking (disk write) — call from a thread, not the event loop."""
+        path = os.path.join(self.directory, f"{time.time_ns()}-{order_id}.bin")
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        if self.owner:
+            # Known before it is visible, so a concurrent _scan can't queue it twice.
+            self._known.add(path)
+        os.replace(tmp, path)
+        if self.owner:
+            self._queue.put(path)
+        return path
+
+    def _scan(self) -> int:
+        """Queues ticket files this process hasn't seen (restart, other workers)."""
+        found = 0
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith(".bin") and path not in self._known:
+                self._known.add(path)
+                self._queue.put(path)
+                found += 1
+        return found
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "printer": self.name,
+            "queue_depth": self.depth(),
+            "printed": self.printed,
+            "failed_attempts": self.failed_attempts,
+            "reconnects": self.reconnects,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else None,
+            "latency_max": latencies[-1] if latencies else None,
+        }
+
+    def _run(self):
+        while True:
+            try:
+                path = self._queue.get(timeout=settings.print_spool_scan_interval)
+            except queue.Empty:
+                try:
+                    self._scan()
+                except OSError as e:
+                    logger.error("[Printer:%s] Spool scan failed: %s", self.name, e)
+                continue
+            if path is None:
+                return
+            try:
+                ticket = _load_ticket(path)
+            except (OSError, ValueError) as e:
+                logger.error("[Printer:%s] Unreadable spool file %s: %s", self.name, path, e)
+                self._quarantine(path)
+                continue
+
+            backoff = 1.0
+            while not self._stopping:
+                if self._print(ticket):
+                    os.remove(path)
+                    self._known.discard(path)
+                    self.printed += 1
+                    if self.on_printed:
+                        self.on_printed(ticket["order_id"], self.name)
+                    self.latencies.append(time.time() - ticket["queued_at"])
+                    observe_span("print", self.latencies[-1])
+                    break
+                self.failed_attempts += 1
+                if backoff == 1.0 and self.on_failed:
+                    # Once per ticket; it keeps retrying and may still print.
+                    self.on_failed(ticket["order_id"], self.name)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, settings.printer_max_backoff)
+
+    def _quarantine(self, path: str):
+        """Moves a ticket that can't be loaded to failed/, out of the scan."""
+        failed_dir = os.path.join(self.directory, "failed")
+        try:
+            os.makedirs(failed_dir, exist_ok=True)
+            os.replace(path, os.path.join(failed_dir, os.path.basename(path)))
+        except OSError as e:
+            # Stays in _known so the next scan doesn't retry it in a loop.
+            logger.error("[Printer:%s] Could not quarantine %s: %s", self.name, path, e)
+            return
+        self._known.discard(path)
+
+    def _print(self, ticket: dict) -> bool:
+        try:
+            p = self._connection()
+            with span("print_write"):
+                p._raw(ticket["payload"])
+            self._last_used = time.monotonic()
+            if self.config["type"].lower() == "dummy":
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("[Printer DUMMY] Output:\n%s", p.output.decode("cp850", errors="replace"))
+                self._close()
+            logger.info("[Printer:%s] ✅ Order #%s printed", self.name, ticket["order_id"])
+            return True
+        except Exception as e:
+            logger.error("[Printer:%s] ❌ Print error for order #%s: %s", self.name, ticket["order_id"], e)
+            self._close()
+            return False
+
+    def _connection(self):
+        if self._printer is not None and time.monotonic() - self._last_used > settings.printer_health_interval:
+            if not self._healthy():
+                logger.warning("[Printer:%s] Health check failed, reconnecting", self.name)
+                self._close()
+        if self._printer is None:
+            self._printer = _open_printer(self.config)
+            self._last_used = time.monotonic()
+            self.reconnects += 1
+        return self._printer
+
+    def _healthy(self) -> bool:
+        try:
+            return self._printer.is_online()
+        except Exception:
+            # Not every transport answers status queries (e.g. write-only
+            # network); then the write error itself forces the reconnect.
+            return True
+
+    def _close(self):
+        if self._printer is not None:
+            try:
+                self._printer.close()
+            except Exception:
+                pass
+            self._printer = None
+
+
+def _load_ticket(path: str) -> dict:
+    name = os.path.basename(path)
+    queued_ns, order_id = name[:-len(".bin")].split("-", 1)
+    with open(path, "rb") as f:
+        return {"order_id": order_id, "payload": f.read(), "queued_at": int(queued_ns) / 1e9}
+
+
+_spools: dict[str, PrinterSpool] = {}
+_owner_lock = None  # open lock file while this process owns the spool
+
+
+def _acquire_spool_lock() -> bool:
+    """flock on PRINT_SPOOL_DIR/.owner.lock. The kernel drops it when the
+    process dies, so a restarted worker can take over."""
+    global _owner_lock
+    os.makedirs(settings.print_spool_dir, exist_ok=True)
+    lock = open(os.path.join(settings.print_spool_dir, ".owner.lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
         return False
+    _owner_lock = lock
+    return True
+
+
+def spool_owner() -> bool:
+    """True in the one process that prints (and recovers orders, see main)."""
+    return _owner_lock is not None
 
 
-def _print_sync(session: CallSession) -> bool:
+def start_spools():
+    """
+    Every web worker calls this. Only the one holding the spool lock opens
+    the printers and runs the spool threads; the rest only write ticket
+    files, so no ticket is printed twice and USB/serial devices have a
+    single owner.
+    """
     try:
-        from escpos.printer import Network, Usb, Serial, Dummy
+        import escpos.printer  # noqa: F401
     except ImportError:
         logger.error("[Printer] python-escpos not installed.")
-        return False
+        return
+    owner = _acquire_spool_lock()
+    if not owner:
+        logger.info("[Printer] Spool owned by another worker; this one only queues tickets")
+    base = _printer_config_from_settings()
+    printers = {"default": base}
+    for name, overrides in settings.printers.items():
+        printers[name] = {**base, **overrides}
+    for name, config in printers.items():
+        spool = PrinterSpool(name, config, settings.print_spool_dir, on_printed=_mark_printed, on_failed=_mark_failed)
+        spool.start(owner)
+        _spools[name] = spool
 
-    printer_type = settings.printer_type.lower()
-    commands = build_comanda_text(session)
 
-    try:
-        if printer_type == "network":
-            p = Network(settings.printer_host, port=settings.printer_port, timeout=5)
-        elif printer_type == "usb":
-            p = Usb(
-                idVendor=int(settings.printer_usb_vendor, 16),
-                idProduct=int(settings.printer_usb_product, 16),
-            )
-        elif printer_type == "serial":
-            p = Serial(devfile=settings.printer_serial_port, baudrate=settings.printer_serial_baud)
-        elif printer_type == "dummy":
-            p = Dummy()
-        else:
-            logger.error(f"[Printer] Unknown printer type: {printer_type}")
-            return False
+def stop_spools():
+    global _owner_lock
+    for spool in _spools.values():
+        spool.stop()
+    _spools.clear()
+    if _owner_lock is not None:
+        _owner_lock.close()
+        _owner_lock = None
 
-        for cmd in commands:
-            ctype = cmd["type"]
-            value = cmd.get("value")
-            if ctype == "text":
-                p.text((value or "") + "\n")
-            elif ctype == "bold_on":
-                p.set(bold=True)
-            elif ctype == "bold_off":
-                p.set(bold=False)
-            elif ctype == "align":
-                p.set(align=value)
-            elif ctype == "feed":
-                p.ln(value or 1)
-            elif ctype == "cut":
-                p.cut()
-
-        if printer_type == "dummy":
-            logger.info(f"[Printer DUMMY] Output:\n{p.output.decode('cp850', errors='replace')}")
-
-        logger.info(f"[Printer] ✅ Order #{session.order_id} printed via {printer_type}")
-        return True
 
+def spool_stats() -> list[dict]:
+    return [spool.stats() for spool in _spools.values()]
+
+
+def route_items(session: CallSession) -> dict[str, list]:
+    """
+    Splits the order by station. PRINTER_ROUTES maps an item ID or a menu
+    category (name_pt) to a printer name; item IDs win over categories and
+    anything unrouted goes to the default printer.
+    """
+    catalog = get_catalog()
+    routes = settings.printer_routes
+    stations: dict[str, list] = {}
+    for item in session.order_items:
+        printer = routes.get(item.item_id) or routes.get(catalog.item_category.get(item.item_id, ""))
+        if printer not in _spools:
+            printer = "default"
+        stations.setdefault(printer, []).append(item)
+    return stations
+
+
+# order_id -> {station: "queued" | "printed" | "failed"}; updated by spool threads.
+_print_status: OrderedDict[str, dict[str, str]] = OrderedDict()
+_PRINT_STATUS_SIZE = 1000
+
+
+def _set_status(order_id: str, station: str, status: str):
+    _print_status.setdefault(order_id, {})[station] = status
+    journal.print_status(order_id, station, status)
+    while len(_print_status) > _PRINT_STATUS_SIZE:
+        _print_status.popitem(last=False)
+
+
+def _mark_printed(order_id: str, station: str):
+    _set_status(order_id, station, "printed")
+
+
+def _mark_failed(order_id: str, station: str):
+    _set_status(order_id, station, "failed")
+
+
+def get_print_status(order_id: str) -> dict | None:
+    """This process's view. Only the spool owner sees tickets print; the
+    other workers should ask journal_print_status."""
+    return _summarize_status(_print_status.get(order_id))
+
+
+def journal_print_status(order_id: str) -> dict | None:
+    """Blocking (SQLite). Latest status per station as any worker saw it."""
+    if not journal._running:
+        return None
+    stations = {}
+    for event in journal.events_for_order(order_id):
+        if event["kind"] == "print":
+            stations[event["station"]] = event["status"]
+    return _summarize_status(stations or None)
+
+
+def _summarize_status(stations: dict[str, str] | None) -> dict | None:
+    if stations is None:
+        return None
+    values = set(stations.values())
+    if values == {"printed"}:
+        status = "printed"
+    elif "failed" in values:
+        status = "failed"
+    elif "printed" in values:
+        status = "partial"
+    else:
+        status = "queued"
+    return {"status": status, "stations": dict(stations)}
+
+
+async def _spool_station(session: CallSession, station: str, items: list, split: bool) -> bool:
+    try:
+        payload = render_comanda_bytes(session, items, station if split else None)
+        # Before submit: the spool thread may print it before to_thread returns.
+        _set_status(session.order_id, station, "queued")
+        await asyncio.to_thread(_spools[station].submit, session.order_id, payload)
+        return True
     except Exception as e:
-        logger.error(f"[Printer] ❌ Print error: {e}")
+        logger.error("[Printer:%s] Failed to spool comanda for order %s: %s", station, session.order_id, e)
+        _set_status(session.order_id, station, "failed")
+        return False
+
+
+async def print_comanda(session: CallSession) -> bool:
+    """Spools one ticket per station, concurrently; True once every ticket is
+    safely on disk, not when they printed (see get_print_status)."""
+    if not _spools:
+        logger.error("[Printer] No printer spool running; order %s not printed", session.order_id)
         return False
+    stations = route_items(session)
+    split = len(stations) > 1 or "default" not in stations
+    results = await asyncio.gather(*(
+        _spool_station(session, station, items, split) for station, items in stations.items()
+    ))
+    return all(results)
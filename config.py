@@ -12,18 +12,84 @@ class Settings(BaseSettings):
     twilio_account_sid: str = ""
     twilio_auth_token: str = ""
     twilio_phone_number: str = ""
+    twilio_api_base: str = "https://api.twilio.com"
+    sms_workers: int = 4
+    sms_queue_size: int = 500
+    sms_max_retries: int = 3
+    sms_retry_backoff: float = 0.5
+    sms_timeout: float = 10.0
 
     # OpenAI
     openai_api_key: str = ""
+    openai_base_url: str = ""  # vazio = API oficial; aponta para um fake no loadtest
     openai_model: str = "gpt-4o"
+    openai_fast_model: str = "gpt-4o-mini"
+    model_routing_enabled: bool = True
+    router_max_fast_words: int = 12
+    openai_stream: bool = True
+    fast_path_enabled: bool = True
+    response_cache_enabled: bool = True
+    response_cache_size: int = 500
+    response_cache_ttl: float = 3600.0
+    llm_keepalive_interval: float = 30.0
+    llm_prime_cache: bool = False
+    llm_prime_interval: float = 240.0
+
+    # Contexto da conversa
+    history_max_turns: int = 6
+    history_token_budget: int = 6000
+    history_summary_model: str = "gpt-4o-mini"
+    history_summary_batch: int = 4
 
     # Stripe
     stripe_secret_key: str = ""
     stripe_webhook_secret: str = ""
+    stripe_api_base: str = ""
     stripe_currency: str = "brl"
+    stripe_timeout: float = 10.0
+    stripe_max_retries: int = 2
+    stripe_max_workers: int = 8
+    stripe_webhook_workers: int = 4
+    stripe_webhook_queue_size: int = 1000
+    stripe_dedup_size: int = 10000
+    stripe_dedup_db: str = ""  # ex: "stripe_events.db" para dedup persistente
+    stripe_dedup_ttl_seconds: int = 7 * 86400  # a Stripe reenvia por até 3 dias
+    stripe_webhook_max_attempts: int = 5
+    payment_wait_timeout: float = 300.0
+
+    # Métricas
+    metrics_loop_lag_interval: float = 0.25
+    profiler_interval: float = 0.0  # ex: 0.01 = 100 amostras/s; 0 desliga
+
+    # Logs
+    log_format: str = "json"  # json | text
+    log_level: str = "INFO"
+    log_queue_size: int = 10000  # cheia: registros novos são descartados
+    log_sample_rates: dict[str, float] = {}  # só logs de turno; ex: {"INFO": 0.1, "DEBUG": 0.01}
+
+    # Sessões
+    session_store: str = "memory"  # memory | redis
+    # Mesmo valor que o Procfile passa para --workers. O Heroku pode definir
+    # WEB_CONCURRENCY sozinho; com mais de um worker as sessões precisam do Redis.
+    web_concurrency: int = 1
+    redis_url: str = "redis://localhost:6379/0"
+    session_ttl_seconds: int = 7200
+    session_idle_ttl_seconds: int = 1800
+    session_sweep_interval: float = 60.0
+    session_max_sessions: int = 1000
+    session_archive_dir: str = "archive"
+
+    # Diário de pedidos (SQLite WAL, append-only)
+    journal_path: str = "orders.db"  # "" desliga
+    journal_batch_size: int = 500
+    journal_synchronous: str = "FULL"  # FULL | NORMAL (NORMAL não faz fsync a cada commit)
+    journal_recovery_hours: float = 24.0
 
     # Menu
     menu_path: str = "menu.json"
+    menu_reload_interval: float = 2.0
+    menu_retrieval_enabled: bool = True
+    menu_retrieval_limit: int = 6
 
     # Impressora de Comanda (ESC/POS)
     printer_type: str = "dummy"
@@ -33,9 +99,19 @@ class Settings(BaseSettings):
     printer_usb_product: str = "0x0202"
     printer_serial_port: str = "/dev/ttyUSB0"
     printer_serial_baud: int = 9600
+    # Estações: PRINTERS='{"grill": {"type": "network", "host": "192.168.1.101"}}'
+    # PRINTER_ROUTES='{"Hambúrgueres": "grill", "Acompanhamentos": "fryer", "DRINK-001": "bar"}'
+    printers: dict[str, dict] = {}
+    printer_routes: dict[str, str] = {}
+    print_spool_dir: str = "spool"
+    print_spool_scan_interval: float = 1.0  # comandas gravadas por outros workers
+    printer_health_interval: float = 30.0
+    printer_max_backoff: float = 30.0
 
     class Config:
         env_file = ".env"
+        # model_routing_enabled não é um campo interno do pydantic.
+        protected_namespaces = ("settings_",)
 
 
 @lru_cache()
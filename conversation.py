@@ -1,100 +1,437 @@
 """
 Motor de conversa — PT-BR com Duda.
 """
+import asyncio
 import json
+import logging
+import time
+from typing import Awaitable, Callable
 from openai import AsyncOpenAI
 from config import get_settings
-from menu import get_menu_for_ai, get_restaurant_info
-from session import CallSession, CallState, OrderItem
+from menu import get_catalog, get_restaurant_info
+from prompt import prompt_builder
+from intents import classifier
+from response_cache import response_cache
+from session import CallSession, CallState
+from streaming import SpeechExtractor, PhraseChunker
+from menu_index import normalize
+from logs import VERBOSE
+from metrics import LLM_LATENCY, MODEL_ESCALATIONS, MODEL_TURNS, TURNS, observe_span, span
 
+logger = logging.getLogger(__name__)
 settings = get_settings()
-client = AsyncOpenAI(api_key=settings.openai_api_key)
-
-
-SYSTEM_PROMPT_TEMPLATE = """
-Você é a Duda, assistente virtual de pedidos do {restaurant_name}.
-Você está atendendo um cliente por ligação telefônica.
-
-IDIOMA: Responda SEMPRE em português brasileiro, independente do idioma do cliente.
-Seja natural e conversacional — esta é uma ligação de voz, então nunca use markdown, listas ou símbolos. Use frases curtas e claras.
-
-SEU CARDÁPIO:
-{menu}
-
-SEU OBJETIVO:
-1. Pergunte o nome do cliente no início e use-o naturalmente durante a conversa.
-2. Anote o pedido do cliente, confirmando cada item.
-3. Após o pedido principal, ofereça UM upsell (ex: "Gostaria de adicionar uma bebida ou acompanhamento, [nome]?").
-4. Leia o pedido completo e o total para confirmação.
-5. Informe que enviará o link de pagamento por SMS.
-6. Após o pagamento confirmado (você será informada), faça na ordem:
-   a. Confirme o endereço de retirada e o tempo de preparo.
-   b. Pergunte se o cliente quer que você repita o endereço.
-   c. Se sim, repita o endereço com clareza.
-   d. Pergunte se o cliente anotou o endereço e o número do pedido.
-   e. Pergunte se pode ajudar com mais alguma coisa.
-   f. Agradeça pelo nome e se despeça com carinho.
-
-ENDEREÇO DO RESTAURANTE: {address}
-
-REGRAS IMPORTANTES:
-- Sempre confirme os itens pelo nome e preço.
-- Se o cliente não for claro, peça gentilmente uma confirmação.
-- Nunca invente itens ou preços. Use apenas itens do cardápio.
-- Respostas CURTAS — máximo 3 frases por turno.
-- Seja calorosa, natural e eficiente.
-- Use o nome do cliente de forma natural — não em toda frase, mas o suficiente para ser pessoal.
-- Nunca leia símbolos como R$ — diga "reais" (ex: "vinte e cinco reais e noventa centavos").
-- Nunca diga "item número", "ponto" ou use listas.
-
-FORMATO DA RESPOSTA:
-Você DEVE sempre responder com um objeto JSON válido (e APENAS JSON, sem texto extra):
-{{
-  "speech": "O que você diz ao cliente",
-  "action": "none | add_item | confirm_order | send_payment | end_call",
-  "items": [
-    {{"id": "item_id", "name": "Nome do Item", "quantity": 1, "unit_price": 72.90}}
-  ]
-}}
-
-- "action" = "add_item" quando o cliente confirma itens específicos para adicionar
-- "action" = "confirm_order" quando o cliente confirma o pedido completo e está pronto para pagar
-- "action" = "send_payment" quando confirmou o pedido e está pronto para enviar o link
-- "action" = "end_call" após confirmar as instruções de retirada
-- "items" só é necessário quando action é "add_item"
-
-ESTADO ATUAL DO PEDIDO:
-{order_summary}
+client = AsyncOpenAI(api_key=settings.openai_api_key, base_url=settings.openai_base_url or None)
+
+SUMMARY_PROMPT = """
+Resuma a conversa abaixo entre a atendente Duda e um cliente de restaurante em no máximo 4 frases curtas.
+Preserve o nome do cliente, preferências, restrições, dúvidas respondidas e mudanças de ideia.
+Não liste os itens do pedido — o estado do pedido é mantido separadamente.
 """
 
+# Saída compacta: o modelo devolve só IDs e quantidades; nome e preço vêm
+# do cardápio no servidor (process_ai_action).
+RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "turno",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "speech": {"type": "string"},
+                "action": {
+                    "type": "string",
+                    "enum": ["none", "update_order", "confirm_order", "send_payment", "end_call"],
+                },
+                "ops": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "op": {"type": "string", "enum": ["add", "remove", "set"]},
+                            "id": {"type": "string"},
+                            "qty": {"type": "integer"},
+                        },
+                        "required": ["op", "id", "qty"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["speech", "action", "ops"],
+            "additionalProperties": False,
+        },
+    },
+}
+MAX_ITEM_QUANTITY = 50
+ACTIONS = set(RESPONSE_FORMAT["json_schema"]["schema"]["properties"]["action"]["enum"])
+OPS = {"add", "remove", "set"}
 
-async def get_ai_response(session: CallSession, customer_speech: str) -> dict:
-    restaurant = get_restaurant_info()
-    menu_text = get_menu_for_ai("pt")
+ESCALATION_NOTE = """
+Sua resposta anterior para este turno foi descartada ({problems}).
+O cliente já ouviu: "{spoken}"
+Gere a resposta completa do turno, mas em "speech" coloque só a continuação, sem repetir o que já foi dito (pode ficar vazio se nada faltar).
+"""
+
+_summarizing: set[str] = set()
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _build_messages(session: CallSession, customer_speech: str) -> list[dict]:
+    session.add_message("user", customer_speech)
+    with span("prompt_build"):
+        return prompt_builder.build_messages(session)
 
-    system_prompt = SYSTEM_PROMPT_TEMPLATE.format(
-        restaurant_name=restaurant["name"],
-        address=restaurant.get("address", ""),
-        menu=menu_text,
-        order_summary=session.get_order_summary() if session.order_items else "Vazio — nenhum item ainda.",
-    )
 
+def _fast_path(session: CallSession, customer_speech: str) -> dict | None:
+    if not settings.fast_path_enabled:
+        return None
+    result = classifier.classify(session, customer_speech)
+    if result is None:
+        return None
     session.add_message("user", customer_speech)
-    messages = [{"role": "system", "content": system_prompt}] + session.conversation_history
+    session.add_message("assistant", result["speech"])
+    logger.info("Atalho local: action %s", result["action"], extra=VERBOSE)
+    TURNS.inc("fast_path")
+    return result
+
+
+def _cached_answer(session: CallSession, customer_speech: str) -> dict | None:
+    speech = response_cache.get(session, customer_speech)
+    if speech is None:
+        return None
+    session.add_message("user", customer_speech)
+    session.add_message("assistant", speech)
+    logger.info("Resposta do cache", extra=VERBOSE)
+    TURNS.inc("cache")
+    return {"speech": speech, "action": "none", "ops": []}
+
+
+# Pistas de que o cliente está mexendo no pedido (normalizadas, sem acento).
+_EDIT_CUES = (
+    "tira", "tirar", "remove", "cancela", "troca", "trocar", "muda", "mudar",
+    "em vez", "ao inves", "mais um", "mais uma", "menos", "so que", "na verdade",
+    "errado", "corrige", "sem ",
+)
+_QUANTITY_WORDS = {"um", "uma", "dois", "duas", "tres", "quatro", "cinco", "meia", "duzia"}
+
+
+class ModelRouter:
+    """
+    Escolhe o modelo de cada turno. Turnos curtos que não mexem no pedido
+    (nome, conversa, dúvidas gerais, pós-pagamento) vão para o modelo rápido;
+    pedidos, edições, confirmação e falas longas vão para o forte. A resposta
+    do rápido passa por validate_turn e, se reprovada, o turno é refeito no
+    forte.
+    """
+
+    def __init__(self, fast_model: str, strong_model: str):
+        self.fast_model = fast_model
+        self.strong_model = strong_model
 
+    @property
+    def enabled(self) -> bool:
+        return settings.model_routing_enabled and self.fast_model != self.strong_model
+
+    def choose(self, session: CallSession, transcript: str) -> str:
+        model, reason = self._choose(session, normalize(transcript))
+        MODEL_TURNS.inc(model, reason)
+        return model
+
+    def _choose(self, session: CallSession, text: str) -> tuple[str, str]:
+        if not self.enabled:
+            return self.strong_model, "routing_off"
+        words = text.split()
+        if len(words) > settings.router_max_fast_words:
+            return self.strong_model, "long"
+        padded = f" {text} "
+        if any(cue in padded for cue in _EDIT_CUES):
+            return self.strong_model, "edit"
+        if session.state == CallState.CONFIRMING_ORDER:
+            # O "sim" já foi resolvido pelo atalho local; o que sobra costuma ser alteração.
+            return self.strong_model, "confirming"
+        if any(w.isdigit() or w in _QUANTITY_WORDS for w in words):
+            return self.strong_model, "quantity"
+        if get_catalog().index.search(text, limit=1):
+            return self.strong_model, "menu_item"
+        return self.fast_model, "simple"
+
+    def record_latency(self, model: str, phase: str, seconds: float):
+        LLM_LATENCY.observe(seconds, model, phase)
+
+    def escalate(self, model: str, problems: list[str]):
+        MODEL_ESCALATIONS.inc(model)
+        logger.warning("Resposta do %s reprovada (%s); refazendo no %s", model, "; ".join(problems), self.strong_model)
+
+
+router = ModelRouter(settings.openai_fast_model, settings.openai_model)
+
+
+def validate_turn(result) -> list[str]:
+    """Mesmo contrato do RESPONSE_FORMAT, mais o que o schema não cobre (IDs do cardápio, quantidades)."""
+    if not isinstance(result, dict):
+        return ["não é um objeto JSON"]
+    problems = []
+    speech = result.get("speech")
+    if not isinstance(speech, str) or not speech.strip():
+        problems.append("speech vazio")
+    action = result.get("action")
+    if action not in ACTIONS:
+        problems.append(f"action inválida: {action!r}")
+    ops = result.get("ops")
+    if not isinstance(ops, list):
+        problems.append("ops ausente")
+        return problems
+    items = get_catalog().items
+    for op in ops:
+        if not isinstance(op, dict) or op.get("op") not in OPS:
+            problems.append(f"op inválida: {op!r}")
+        elif op.get("id") not in items:
+            problems.append(f"item desconhecido: {op.get('id')!r}")
+        elif not isinstance(op.get("qty"), int) or not 0 <= op["qty"] <= MAX_ITEM_QUANTITY:
+            problems.append(f"quantidade inválida: {op.get('qty')!r}")
+    if action == "update_order" and not ops:
+        problems.append("update_order sem ops")
+    return problems
+
+
+def _parse_turn(raw: str) -> tuple[dict | None, list[str]]:
+    with span("json_parse"):
+        try:
+            result = json.loads(raw)
+        except ValueError as e:
+            return None, [f"JSON inválido: {e}"]
+    return result, validate_turn(result)
+
+
+async def _request(session: CallSession, model: str, messages: list[dict]) -> str:
+    start = time.perf_counter()
     response = await client.chat.completions.create(
-        model=settings.openai_model,
+        model=model,
+        messages=messages,
+        temperature=0.7,
+        response_format=RESPONSE_FORMAT,
+    )
+    elapsed = time.perf_counter() - start
+    observe_span("llm_total", elapsed)
+    router.record_latency(model, "total", elapsed)
+    TURNS.inc("llm")
+
+    prompt_builder.record_usage(session, response.usage)
+    return response.choices[0].message.content
+
+
+async def _request_stream(
+    session: CallSession,
+    model: str,
+    messages: list[dict],
+    on_speech: Callable[[str], Awaitable[None]],
+) -> str:
+    start = time.perf_counter()
+    first_token = True
+    stream = await client.chat.completions.create(
+        model=model,
         messages=messages,
         temperature=0.7,
-        response_format={"type": "json_object"},
+        response_format=RESPONSE_FORMAT,
+        stream=True,
+        stream_options={"include_usage": True},
     )
 
-    raw = response.choices[0].message.content
-    result = json.loads(raw)
+    extractor = SpeechExtractor("speech")
+    chunker = PhraseChunker()
+    try:
+        async for chunk in stream:
+            if chunk.usage:
+                prompt_builder.record_usage(session, chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if not delta:
+                continue
+            if first_token:
+                first_token = False
+                elapsed = time.perf_counter() - start
+                observe_span("llm_ttft", elapsed)
+                router.record_latency(model, "ttft", elapsed)
+            for phrase in chunker.push(extractor.feed(delta)):
+                await on_speech(phrase)
+    finally:
+        # Cancelado no meio (barge-in): fechar a conexão faz a OpenAI parar de gerar.
+        await stream.close()
+
+    rest = chunker.flush()
+    if rest:
+        await on_speech(rest)
+    elapsed = time.perf_counter() - start
+    observe_span("llm_total", elapsed)
+    router.record_latency(model, "total", elapsed)
+    TURNS.inc("llm")
+    return extractor.raw
+
+
+def _final_result(result: dict | None, problems: list[str]) -> dict:
+    if result is None:
+        raise ValueError(f"Resposta do modelo inutilizável: {'; '.join(problems)}")
+    return result
+
+
+async def get_ai_response(session: CallSession, customer_speech: str) -> dict:
+    local = _fast_path(session, customer_speech) or _cached_answer(session, customer_speech)
+    if local is not None:
+        return local
+
+    messages = _build_messages(session, customer_speech)
+    model = router.choose(session, customer_speech)
+    result, problems = _parse_turn(await _request(session, model, messages))
+
+    if problems and model != router.strong_model:
+        router.escalate(model, problems)
+        result, problems = _parse_turn(await _request(session, router.strong_model, messages))
+
+    result = _final_result(result, problems)
     session.add_message("assistant", result.get("speech", ""))
+    response_cache.put(session, customer_speech, result)
+    schedule_history_summary(session)
     return result
 
 
+async def get_ai_response_stream(
+    session: CallSession,
+    customer_speech: str,
+    on_speech: Callable[[str], Awaitable[None]],
+) -> dict:
+    """
+    Igual a get_ai_response, mas chama on_speech com cada frase do campo
+    "speech" assim que ela chega. O dict final (com action/items) só é
+    devolvido quando o JSON está completo.
+    """
+    local = _fast_path(session, customer_speech) or _cached_answer(session, customer_speech)
+    if local is not None:
+        await on_speech(local["speech"])
+        return local
+
+    messages = _build_messages(session, customer_speech)
+    model = router.choose(session, customer_speech)
+    spoken: list[str] = []
+
+    async def speak(phrase: str):
+        spoken.append(phrase)
+        await on_speech(phrase)
+
+    result, problems = _parse_turn(await _request_stream(session, model, messages, speak))
+
+    if problems and model != router.strong_model:
+        router.escalate(model, problems)
+        said = "".join(spoken).strip()
+        retry = messages
+        if said:
+            # A fala do rápido já saiu no telefone: o forte só continua a partir dela.
+            note = ESCALATION_NOTE.format(problems="; ".join(problems), spoken=said)
+            retry = messages + [{"role": "system", "content": note}]
+        result, problems = _parse_turn(await _request_stream(session, router.strong_model, retry, on_speech))
+        if result is not None and said:
+            result["speech"] = f"{said} {result.get('speech', '')}".strip()
+
+    result = _final_result(result, problems)
+    session.add_message("assistant", result.get("speech", ""))
+    response_cache.put(session, customer_speech, result)
+    schedule_history_summary(session)
+    return result
+
+
+def record_interruption(session: CallSession, spoken: str):
+    """
+    Deixa no histórico só o que o cliente chegou a ouvir. Se a última
+    mensagem é da Duda, ela é cortada no ponto da interrupção; se a resposta
+    foi abandonada antes de ser gravada, entra só o trecho falado.
+    """
+    history = session.conversation_history
+    if history and history[-1]["role"] == "assistant":
+        if spoken:
+            history[-1]["content"] = spoken
+        else:
+            history.pop()
+    elif spoken:
+        session.add_message("assistant", spoken)
+
+
+def schedule_history_summary(session: CallSession):
+    """Dobra as mensagens que saíram da janela num resumo, sem bloquear o turno."""
+    window_start = max(0, len(session.conversation_history) - 2 * settings.history_max_turns)
+    pending = window_start - session.summarized_upto
+    if pending < settings.history_summary_batch or session.call_sid in _summarizing:
+        return
+    _summarizing.add(session.call_sid)
+    task = asyncio.create_task(_summarize_history(session, window_start))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _summarize_history(session: CallSession, upto: int):
+    try:
+        folded = session.conversation_history[session.summarized_upto:upto]
+        transcript = "\n".join(
+            f"{'Cliente' if m['role'] == 'user' else 'Duda'}: {m['content']}" for m in folded
+        )
+        if session.history_summary:
+            transcript = f"Resumo anterior: {session.history_summary}\n\n{transcript}"
+
+        response = await client.chat.completions.create(
+            model=settings.history_summary_model,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": transcript},
+            ],
+            temperature=0,
+            max_tokens=200,
+        )
+        session.history_summary = response.choices[0].message.content.strip()
+        session.summarized_upto = upto
+        logger.info("Histórico resumido até a mensagem %s", upto)
+    except Exception as e:
+        logger.error("Erro ao resumir histórico: %s", e)
+    finally:
+        _summarizing.discard(session.call_sid)
+
+
+_last_warm = 0.0
+_primed_version: str | None = None
+_primed_at = 0.0
+
+
+async def warm_up(session: CallSession):
+    """
+    Roda enquanto a Twilio toca o welcomeGreeting: monta o prefixo do prompt
+    do cardápio fixado na ligação (o mesmo que build_messages vai usar),
+    garante uma conexão keep-alive aberta com a OpenAI e, se configurado,
+    manda uma requisição mínima para popular o cache de prompt do provedor.
+    """
+    global _last_warm, _primed_version, _primed_at
+    try:
+        system_prompt = prompt_builder.system_prompt(session)
+        now = time.monotonic()
+
+        if now - _last_warm > settings.llm_keepalive_interval:
+            _last_warm = now
+            await client.with_options(timeout=5.0).models.retrieve(settings.openai_model)
+
+        version = session.menu_version
+        stale = now - _primed_at > settings.llm_prime_interval
+        if settings.llm_prime_cache and (version != _primed_version or stale):
+            _primed_version, _primed_at = version, now
+            await client.chat.completions.create(
+                model=settings.openai_model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": "."},
+                ],
+                max_tokens=1,
+            )
+        logger.info("Aquecimento concluído", extra=VERBOSE)
+    except Exception as e:
+        logger.warning("Aquecimento falhou (seguindo a frio): %s", e)
+
+
 async def get_initial_greeting(session: CallSession, detected_lang: str = "pt") -> dict:
     session.language = "pt"
     restaurant = get_restaurant_info()
@@ -119,24 +456,39 @@ async def get_waiting_for_payment_message(session: CallSession) -> str:
     return "Enviei o link de pagamento por SMS. Por favor, finalize o pagamento e aguarde a confirmação."
 
 
+def apply_order_ops(session: CallSession, ops: list[dict]) -> list[str]:
+    """Aplica add/remove/set resolvendo nome e preço pelo cardápio.
+    Retorna os IDs rejeitados (desconhecidos ou quantidade inválida)."""
+    catalog = get_catalog()
+    rejected = []
+    for op in ops:
+        item_id = op.get("id")
+        item = catalog.items.get(item_id)
+        qty = op.get("qty", 1)
+        kind = op.get("op", "add")
+        if item is None or not isinstance(qty, int) or not 0 <= qty <= MAX_ITEM_QUANTITY:
+            rejected.append(str(item_id))
+            continue
+        if kind == "remove":
+            session.remove_item(item_id)
+        elif kind == "set" and session.find_item(item_id):
+            session.set_item_quantity(item_id, qty)
+        elif qty > 0:
+            session.add_item(item_id, item.get("name_pt", item_id), qty, item["price"])
+    if rejected:
+        logger.warning("Itens rejeitados da resposta do modelo: %s", rejected)
+    return rejected
+
+
 def process_ai_action(session: CallSession, ai_result: dict):
     action = ai_result.get("action", "none")
     session.language = "pt"
 
-    if action == "add_item":
-        items_data = ai_result.get("items", [])
-        for item_data in items_data:
-            existing = next((i for i in session.order_items if i.item_id == item_data["id"]), None)
-            if existing:
-                existing.quantity += item_data.get("quantity", 1)
-            else:
-                order_item = OrderItem(
-                    item_id=item_data["id"],
-                    name=item_data["name"],
-                    quantity=item_data.get("quantity", 1),
-                    unit_price=item_data["unit_price"],
-                )
-                session.order_items.append(order_item)
+    ops = ai_result.get("ops") or []
+    if ops:
+        ai_result["rejected"] = apply_order_ops(session, ops)
+
+    if action == "update_order":
         session.state = CallState.TAKING_ORDER
     elif action == "confirm_order":
         session.state = CallState.CONFIRMING_ORDER
@@ -4,43 +4,40 @@ Twilio Voice Webhook Handler — ConversationRelay PT-BR com Duda.
 import json
 import asyncio
 import logging
+import time
+from xml.sax.saxutils import quoteattr
 from fastapi import APIRouter, Form, WebSocket, WebSocketDisconnect
 from fastapi.responses import Response
-from session import create_session, get_session, CallState
+from session import create_session, get_session, save_session, wait_for_payment, CallState
+from menu import get_catalog
 from conversation import (
+    warm_up,
     get_ai_response,
+    get_ai_response_stream,
     get_initial_greeting,
     get_payment_confirmation_message,
     get_waiting_for_payment_message,
     process_ai_action,
+    record_interruption,
 )
-from stripe_handler import create_payment_link
+from stripe_handler import create_payment_link, payment_links
 from sms import send_payment_sms
 from config import get_settings
+from journal import journal
+from logs import VERBOSE, bind_call
+from metrics import TURNS_CANCELLED, call_ended, call_started, observe_span, span
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/voice", tags=["voice"])
 settings = get_settings()
 
 
-@router.post("/incoming")
-async def handle_incoming_call(
-    CallSid: str = Form(...),
-    From: str = Form(...),
-    To: str = Form(...),
-):
-    logger.info(f"Incoming call: {CallSid} from {From}")
-    session = create_session(CallSid, From)
-    greeting = await get_initial_greeting(session)
-
-    ws_url = f"{settings.base_url.replace('https://', 'wss://')}/voice/ws"
-
-    twiml = f"""<?xml version="1.0" encoding="UTF-8"?>
+TWIML_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
 <Response>
   <Connect>
     <ConversationRelay
-      url="{ws_url}"
-      welcomeGreeting="{greeting['speech']}"
+      url={ws_url}
+      welcomeGreeting={greeting}
       ttsProvider="ElevenLabs"
       voice="pFZP5JQG7iQjIQuC4Bku"
       language="pt-BR"
@@ -50,124 +47,320 @@ async def handle_incoming_call(
   </Connect>
 </Response>"""
 
-    return Response(content=twiml, media_type="application/xml")
+TURN_ERROR_SPEECH = "Desculpe, tive um probleminha aqui. Pode repetir, por favor?"
+
+_twiml: tuple[str, str] | None = None  # (versão do cardápio, TwiML pronto)
+_warmups: set[asyncio.Task] = set()
+
+
+def render_twiml() -> str:
+    """O TwiML é igual para todas as ligações: renderizado uma vez por versão do cardápio."""
+    global _twiml
+    catalog = get_catalog()
+    if _twiml is None or _twiml[0] != catalog.version:
+        ws_url = f"{settings.base_url.replace('https://', 'wss://')}/voice/ws"
+        _twiml = (catalog.version, TWIML_TEMPLATE.format(
+            ws_url=quoteattr(ws_url),
+            greeting=quoteattr(catalog.restaurant["agent"]["greeting_pt"]),
+        ))
+    return _twiml[1]
+
+
+@router.post("/incoming")
+async def handle_incoming_call(
+    CallSid: str = Form(...),
+    From: str = Form(...),
+    To: str = Form(...),
+):
+    session = await create_session(CallSid, From)
+    journal.order_created(session)
+    bind_call(CallSid, session.order_id)
+    logger.info("Incoming call from %s", From)
+    await get_initial_greeting(session)
+    # Fixa o cardápio antes de salvar: com Redis o WebSocket lê outra cópia da sessão.
+    session.menu_version = get_catalog().version
+    await save_session(session)
+
+    task = asyncio.create_task(warm_up(session))
+    _warmups.add(task)
+    task.add_done_callback(_warmups.discard)
+
+    return Response(content=render_twiml(), media_type="application/xml")
+
+
+class FrameWriter:
+    """
+    Única tarefa que escreve no WebSocket. Frames de texto que se acumulam
+    na fila enquanto um envio está em curso saem juntos num frame só.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self._queue: asyncio.Queue[dict] = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    def text(self, token: str, last: bool = True):
+        self._queue.put_nowait({"type": "text", "token": token, "last": last})
+
+    def end(self):
+        self._queue.put_nowait({"type": "end"})
+
+    def clear(self) -> int:
+        """Barge-in: descarta o texto que ainda não saiu. Frames "end" ficam."""
+        kept, dropped = [], 0
+        while not self._queue.empty():
+            frame = self._queue.get_nowait()
+            if frame["type"] == "text":
+                dropped += 1
+            else:
+                kept.append(frame)
+        for frame in kept:
+            self._queue.put_nowait(frame)
+        return dropped
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        try:
+            while True:
+                frame = await self._queue.get()
+                while frame["type"] == "text" and not frame["last"] and not self._queue.empty():
+                    following = self._queue.get_nowait()
+                    if following["type"] != "text":
+                        await self._send(frame)
+                        frame = following
+                        break
+                    frame = {
+                        "type": "text",
+                        "token": frame["token"] + following["token"],
+                        "last": following["last"],
+                    }
+                await self._send(frame)
+        except Exception as e:
+            logger.info("Writer encerrado: %s", e, extra=VERBOSE)
+
+    async def _send(self, frame: dict):
+        await self.websocket.send_text(json.dumps(frame))
+
+
+class CallConnection:
+    """
+    Uma ligação, três tarefas: o leitor (websocket_endpoint) sempre drena os
+    frames da Twilio; cada turno roda numa task própria, que é cancelada se
+    o cliente interromper ou falar de novo enquanto a resposta ainda está
+    sendo gerada; e o FrameWriter é o único que escreve no socket.
+
+    Um turno tem duas fases. A geração (LLM) pode ser abandonada. Os efeitos
+    (pedido, link, SMS, sessão salva) rodam protegidos e nunca ficam pela
+    metade; um turno só começa quando o anterior terminou de aplicá-los.
+    """
+
+    def __init__(self, websocket: WebSocket):
+        self.writer = FrameWriter(websocket)
+        self.call_sid: str | None = None
+        self.session = None
+        self.closed = False
+        self.turn: asyncio.Task | None = None
+        self._generating: asyncio.Task | None = None
+        self._spoken: list[str] = []  # texto enviado no turno em geração
+        self._lock = asyncio.Lock()
+        self._tasks: set[asyncio.Task] = set()
+
+    async def setup(self, call_sid: str):
+        self.call_sid = call_sid
+        self.session = await get_session(call_sid)
+        # As tasks de turno, pagamento e hang-up herdam o contexto daqui.
+        bind_call(call_sid, self.session.order_id if self.session else None)
+        if self.session:
+            call_started()
+        logger.info("ConversationRelay conectado")
+
+    def prompt(self, transcript: str):
+        if not self.session or not transcript:
+            return
+        logger.info("Cliente disse: '%s'", transcript, extra=VERBOSE)
+        if self._generating is not None:
+            # Falou de novo antes da resposta terminar: o que já saiu fica no histórico.
+            self._cancel_generation("prompt", "".join(self._spoken).strip())
+        self.turn = self._spawn(self._run_turn(transcript))
+
+    def interrupt(self, data: dict):
+        spoken = (data.get("utteranceUntilInterrupt") or "").strip()
+        dropped = self.writer.clear()
+        logger.info("Cliente interrompeu (%s frames descartados)", dropped)
+        if not self.session:
+            return
+        if self._generating is not None:
+            self._cancel_generation("interrupt", spoken)
+        else:
+            record_interruption(self.session, spoken)
+
+    def _cancel_generation(self, reason: str, spoken: str):
+        self._generating.cancel()
+        self._generating = None
+        TURNS_CANCELLED.inc(reason)
+        # A task só vê o cancelamento no próximo await, antes de gravar a resposta.
+        record_interruption(self.session, spoken)
+
+    async def _run_turn(self, transcript: str):
+        async with self._lock:
+            turn = asyncio.current_task()
+            turn_start = time.perf_counter()
+            self._spoken = []
+
+            async def speak(token: str):
+                if not self._spoken:
+                    observe_span("turn_first_text", time.perf_counter() - turn_start)
+                self._spoken.append(token)
+                self.writer.text(token, last=False)
+
+            self._generating = turn
+            try:
+                if settings.openai_stream:
+                    ai_result = await get_ai_response_stream(self.session, transcript, speak)
+                else:
+                    ai_result = await get_ai_response(self.session, transcript)
+            except Exception as e:
+                # Erro do LLM ou resposta inválida: o turno precisa fechar com
+                # last: true, senão a fala parcial fica aberta e a linha muda.
+                logger.error("Erro ao gerar resposta: %r", e)
+                self._reply(TURN_ERROR_SPEECH, turn_start)
+                return
+            finally:
+                if self._generating is turn:
+                    self._generating = None
+            await asyncio.shield(self._commit(ai_result, turn_start))
+
+    async def _commit(self, ai_result: dict, turn_start: float):
+        session = self.session
+        fingerprint = session.order_fingerprint()
+        with span("process_ai_action"):
+            process_ai_action(session, ai_result)
+        await save_session(session)
+        if session.order_fingerprint() != fingerprint:
+            journal.items_changed(session)
+        if not session.payment_link:
+            payment_links.sync(session)
+
+        ai_speech = ai_result.get("speech", "")
+        action = ai_result.get("action", "none")
+        logger.info("Duda diz: '%s' | action: %s", ai_speech, action, extra=VERBOSE)
+
+        # Com streaming a fala já saiu em frames "last: false"; falta só fechar o turno.
+        pending = "" if self._spoken else ai_speech
+
+        if action == "send_payment" and not session.payment_link:
+            try:
+                payment_link, payment_intent_id = await create_payment_link(session)
+                session.payment_link = payment_link
+                session.payment_intent_id = payment_intent_id
+                journal.payment_link_sent(session)
+
+                send_payment_sms(
+                    to_number=session.from_number,
+                    order_id=session.order_id,
+                    payment_link=payment_link,
+                    total=session.order_total,
+                    language="pt",
+                )
+
+                session.state = CallState.PAYMENT_SENT
+                await save_session(session)
+                waiting_msg = await get_waiting_for_payment_message(session)
+                # Fala já transmitida: o aviso continua a frase, com espaço.
+                text = f" {waiting_msg}" if self._spoken else f"{pending} {waiting_msg}".strip()
+                self._reply(text, turn_start)
+                if not self.closed:
+                    self._spawn(self._confirm_payment())
+                return
+
+            except Exception as e:
+                logger.error("Erro no pagamento: %s", e)
+                pending = "Desculpe, houve um problema ao processar o pagamento. Por favor, ligue novamente."
+
+        self._reply(pending, turn_start)
+        if action == "end_call" and not self.closed:
+            self._spawn(self._hang_up(3))
+
+    def _reply(self, text: str, turn_start: float):
+        """Fecha o turno (last: true). É aqui que o silêncio do cliente acaba."""
+        elapsed = time.perf_counter() - turn_start
+        if not self._spoken:
+            observe_span("turn_first_text", elapsed)
+        observe_span("turn_total", elapsed)
+        self.writer.text(text)
+
+    async def _confirm_payment(self):
+        session = self.session
+        confirmed = await wait_for_payment(self.call_sid, settings.payment_wait_timeout)
+        if not confirmed:
+            logger.warning("Timeout de pagamento")
+            return
+
+        confirmation_msg = await get_payment_confirmation_message(session)
+        async with self._lock:
+            session.state = CallState.PAYMENT_CONFIRMED
+            session.payment_confirmed = True
+            session.add_message("assistant", confirmation_msg)
+            await save_session(session)
+        self.writer.text(confirmation_msg)
+        await self._hang_up(5)
+
+    async def _hang_up(self, delay: float):
+        await asyncio.sleep(delay)
+        self.writer.end()
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(_log_task_failure)
+        return task
+
+    async def close(self):
+        self.closed = True
+        for task in list(self._tasks):
+            task.cancel()
+        await self.writer.stop()
+        if self.call_sid:
+            payment_links.forget(self.call_sid)
+        if self.session:
+            call_ended(self.session.token_usage)
+
+
+def _log_task_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.error("Erro na ligação: %s", task.exception())
 
 
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    call_sid = None
-    session = None
+    connection = CallConnection(websocket)
 
     try:
         async for message in websocket.iter_text():
-            data = json.loads(message)
+            with span("ws_receive"):
+                data = json.loads(message)
             event_type = data.get("type")
 
             if event_type == "setup":
-                call_sid = data.get("callSid")
-                session = get_session(call_sid)
-                logger.info(f"ConversationRelay conectado: {call_sid}")
+                await connection.setup(data.get("callSid"))
 
             elif event_type == "prompt":
-                if not session:
-                    continue
-
-                transcript = data.get("voicePrompt", "").strip()
-                logger.info(f"[{call_sid}] Cliente disse: '{transcript}'")
-
-                if not transcript:
-                    continue
-
-                ai_result = await get_ai_response(session, transcript)
-                process_ai_action(session, ai_result)
-
-                ai_speech = ai_result.get("speech", "")
-                action = ai_result.get("action", "none")
-                logger.info(f"[{call_sid}] Duda diz: '{ai_speech}' | action: {action}")
-
-                if action == "send_payment" and not session.payment_link:
-                    try:
-                        payment_link, payment_intent_id = await create_payment_link(session)
-                        session.payment_link = payment_link
-                        session.payment_intent_id = payment_intent_id
-
-                        await send_payment_sms(
-                            to_number=session.from_number,
-                            order_id=session.order_id,
-                            payment_link=payment_link,
-                            total=session.order_total,
-                            language="pt",
-                        )
-
-                        session.state = CallState.PAYMENT_SENT
-                        waiting_msg = await get_waiting_for_payment_message(session)
-                        full_msg = f"{ai_speech} {waiting_msg}"
-
-                        await websocket.send_text(json.dumps({
-                            "type": "text",
-                            "token": full_msg,
-                            "last": True,
-                        }))
-
-                        asyncio.create_task(
-                            wait_for_payment_and_confirm(websocket, session, call_sid)
-                        )
-                        continue
-
-                    except Exception as e:
-                        logger.error(f"Erro no pagamento: {e}")
-                        ai_speech = "Desculpe, houve um problema ao processar o pagamento. Por favor, ligue novamente."
-
-                if action == "end_call":
-                    await websocket.send_text(json.dumps({
-                        "type": "text",
-                        "token": ai_speech,
-                        "last": True,
-                    }))
-                    await asyncio.sleep(3)
-                    await websocket.send_text(json.dumps({"type": "end"}))
-                    break
-
-                await websocket.send_text(json.dumps({
-                    "type": "text",
-                    "token": ai_speech,
-                    "last": True,
-                }))
+                connection.prompt(data.get("voicePrompt", "").strip())
 
             elif event_type == "interrupt":
-                logger.info(f"[{call_sid}] Cliente interrompeu")
+                connection.interrupt(data)
 
             elif event_type == "error":
-                logger.error(f"[{call_sid}] Erro ConversationRelay: {data}")
+                logger.error("Erro ConversationRelay: %s", data)
 
     except WebSocketDisconnect:
-        logger.info(f"WebSocket desconectado: {call_sid}")
+        logger.info("WebSocket desconectado")
     except Exception as e:
-        logger.error(f"Erro WebSocket: {e}")
-
-
-async def wait_for_payment_and_confirm(websocket: WebSocket, session, call_sid: str):
-    max_wait = 300
-    interval = 5
-    elapsed = 0
-
-    while elapsed < max_wait:
-        await asyncio.sleep(interval)
-        elapsed += interval
-
-        if session.payment_confirmed:
-            confirmation_msg = await get_payment_confirmation_message(session)
-            try:
-                await websocket.send_text(json.dumps({
-                    "type": "text",
-                    "token": confirmation_msg,
-                    "last": True,
-                }))
-                await asyncio.sleep(5)
-                await websocket.send_text(json.dumps({"type": "end"}))
-            except Exception as e:
-                logger.error(f"Erro ao enviar confirmação: {e}")
-            return
-
-    logger.warning(f"Timeout de pagamento para ligação {call_sid}")
+        logger.error("Erro WebSocket: %s", e)
+    finally:
+        await connection.close()
@@ -0,0 +1,164 @@
+"""
+Atalho local de intenção — resolve sem LLM os turnos triviais ("sim",
+"só isso", "obrigado") quando o estado da ligação deixa a resposta óbvia.
+Na dúvida, retorna None e o turno segue para o modelo.
+"""
+from menu import get_restaurant_info
+from menu_index import normalize
+from session import CallSession, CallState
+
+
+AFFIRM = {
+    "sim", "isso", "isso mesmo", "isso ai", "pode", "pode sim", "pode mandar",
+    "pode enviar", "manda", "pode ser", "claro", "claro que sim", "com certeza",
+    "ok", "okay", "beleza", "confirmo", "confirmado", "certo", "ta certo",
+    "esta certo", "perfeito", "fechado", "exato", "sim pode", "sim por favor",
+    "sim pode mandar", "isso pode mandar", "ta bom", "esta bom",
+}
+DENY = {"nao", "nao obrigado", "nao obrigada", "nao precisa", "nao nao", "nao valeu"}
+DONE_ORDERING = {
+    "so isso", "e so isso", "so isso mesmo", "e isso", "so", "mais nada",
+    "nada mais", "por enquanto e isso", "nao so isso", "nao e so isso",
+    "so isso obrigado", "so isso obrigada", "acho que e isso",
+}
+THANKS_BYE = {
+    "obrigado", "obrigada", "muito obrigado", "muito obrigada", "valeu",
+    "brigado", "brigada", "tchau", "ate mais", "ate logo", "obrigado tchau",
+    "obrigada tchau", "valeu tchau", "nao obrigado tchau", "nao obrigada tchau",
+}
+
+# Pistas na última fala da Duda que tornam um "não" inequívoco.
+_OFFERS_MORE = ("mais alguma coisa", "gostaria de adicionar", "quer adicionar", "algo mais")
+_OFFERS_ADDRESS = ("repetisse o endereco", "repita o endereco", "repetir o endereco")
+_OFFERS_PAYMENT = ("link", "pagamento", "pagar")
+
+
+_UNITS = [
+    "zero", "um", "dois", "três", "quatro", "cinco", "seis", "sete", "oito", "nove",
+    "dez", "onze", "doze", "treze", "quatorze", "quinze", "dezesseis", "dezessete",
+    "dezoito", "dezenove",
+]
+_TENS = ["", "", "vinte", "trinta", "quarenta", "cinquenta", "sessenta", "setenta", "oitenta", "noventa"]
+_HUNDREDS = [
+    "", "cento", "duzentos", "trezentos", "quatrocentos", "quinhentos",
+    "seiscentos", "setecentos", "oitocentos", "novecentos",
+]
+
+
+def _number_words(n: int) -> str:
+    if n < 20:
+        return _UNITS[n]
+    if n < 100:
+        tens, unit = divmod(n, 10)
+        return _TENS[tens] + (f" e {_UNITS[unit]}" if unit else "")
+    if n == 100:
+        return "cem"
+    if n < 1000:
+        hundreds, rest = divmod(n, 100)
+        return _HUNDREDS[hundreds] + (f" e {_number_words(rest)}" if rest else "")
+    thousands, rest = divmod(n, 1000)
+    words = "mil" if thousands == 1 else f"{_number_words(thousands)} mil"
+    if not rest:
+        return words
+    joiner = " e " if rest < 100 or rest % 100 == 0 else " "
+    return words + joiner + _number_words(rest)
+
+
+def reais_por_extenso(value: float) -> str:
+    cents_total = int(round(value * 100))
+    reais, cents = divmod(cents_total, 100)
+    parts = []
+    if reais:
+        parts.append(f"{_number_words(reais)} {'real' if reais == 1 else 'reais'}")
+    if cents:
+        parts.append(f"{_number_words(cents)} {'centavo' if cents == 1 else 'centavos'}")
+    return " e ".join(parts) or "zero reais"
+
+
+def _spoken_order(session: CallSession) -> str:
+    items = [f"{_number_words(i.quantity)} {i.name}" for i in session.order_items]
+    if len(items) > 1:
+        return ", ".join(items[:-1]) + " e " + items[-1]
+    return items[0]
+
+
+def _last_assistant(session: CallSession) -> str:
+    for message in reversed(session.conversation_history):
+        if message["role"] == "assistant":
+            return normalize(message["content"])
+    return ""
+
+
+class IntentClassifier:
+    def __init__(self):
+        self.total = 0
+        self.hits = 0
+        self.by_intent: dict[str, int] = {}
+
+    def classify(self, session: CallSession, transcript: str) -> dict | None:
+        """Mesmo contrato da resposta do LLM ({speech, action}, sem ops) ou None."""
+        self.total += 1
+        result, intent = self._classify(session, normalize(transcript))
+        if result is not None:
+            self.hits += 1
+            self.by_intent[intent] = self.by_intent.get(intent, 0) + 1
+        return result
+
+    def _classify(self, session: CallSession, text: str) -> tuple[dict | None, str]:
+        if not text or session.state in (CallState.GREETING, CallState.DETECTING_LANGUAGE):
+            return None, ""
+        last = _last_assistant(session)
+
+        if session.payment_confirmed:
+            if any(cue in last for cue in _OFFERS_ADDRESS):
+                if text in AFFIRM:
+                    address = get_restaurant_info().get("address", "nosso restaurante")
+                    return {
+                        "speech": f"Claro! O endereço é {address}. Você anotou o endereço e o número do pedido, {session.order_id}?",
+                        "action": "none",
+                    }, "repeat_address"
+                if text in DENY:
+                    return {
+                        "speech": "Tudo bem! Posso ajudar com mais alguma coisa?",
+                        "action": "none",
+                    }, "skip_address"
+            if text in THANKS_BYE or (text in DENY and any(cue in last for cue in _OFFERS_MORE)):
+                return {
+                    "speech": "Eu que agradeço! Bom apetite e até logo.",
+                    "action": "end_call",
+                }, "goodbye"
+            return None, ""
+
+        # Só é "pode mandar o link" se a Duda acabou de oferecer o link — um
+        # "sim" para uma sugestão de adicional não pode disparar o pagamento.
+        offers_payment = any(cue in last for cue in _OFFERS_PAYMENT) and not any(cue in last for cue in _OFFERS_MORE)
+        if session.state == CallState.CONFIRMING_ORDER and text in AFFIRM and offers_payment:
+            return {
+                "speech": "Perfeito!",
+                "action": "send_payment",
+            }, "confirm_payment"
+
+        if session.state in (CallState.TAKING_ORDER, CallState.UPSELL) and session.order_items:
+            done = text in DONE_ORDERING or (text in DENY and any(cue in last for cue in _OFFERS_MORE))
+            if done:
+                return {
+                    "speech": (
+                        f"Certo! Seu pedido ficou: {_spoken_order(session)}. "
+                        f"O total é {reais_por_extenso(session.order_total)}. "
+                        "Posso enviar o link de pagamento?"
+                    ),
+                    "action": "confirm_order",
+                }, "done_ordering"
+
+        return None, ""
+
+    def stats(self) -> dict:
+        return {
+            "total": self.total,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.total, 4) if self.total else 0.0,
+            "by_intent": dict(self.by_intent),
+        }
+
+
+classifier = IntentClassifier()
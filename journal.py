@@ -0,0 +1,270 @@
+"""
+Diário de pedidos — eventos append-only em SQLite (WAL): pedido criado,
+itens alterados, link de pagamento, pagamento confirmado e status de
+impressão. Sobrevive a restarts e serve de histórico para análise.
+
+O event loop só enfileira o evento; uma thread grava em lotes, um commit
+por lote (group commit). Com a fila cheia de eventos, um único fsync cobre
+centenas deles, então JOURNAL_SYNCHRONOUS=FULL não custa latência de turno.
+"""
+import asyncio
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from config import get_settings
+from session import CallSession, CallState, OrderItem
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS order_events (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    order_id TEXT NOT NULL,
+    call_sid TEXT,
+    kind TEXT NOT NULL,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS order_events_order ON order_events (order_id, id);
+CREATE INDEX IF NOT EXISTS order_events_call ON order_events (call_sid);
+CREATE INDEX IF NOT EXISTS order_events_day ON order_events (day);
+"""
+
+_INSERT = "INSERT INTO order_events (ts, day, order_id, call_sid, kind, data) VALUES (?, ?, ?, ?, ?, ?)"
+
+
+class OrderJournal:
+    def __init__(self, path: str, batch_size: int = 500, synchronous: str = "FULL"):
+        self.path = path
+        self.batch_size = batch_size
+        self.synchronous = synchronous
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._db: sqlite3.Connection | None = None
+        self._running = False
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    # ------------------------------------------------------------ ciclo de vida
+
+    def start(self):
+        """Bloqueante (abre o banco) — chamar fora do event loop."""
+        if not self.path or self._running:
+            return
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"PRAGMA synchronous={self.synchronous}")
+        self._db.executescript(_SCHEMA)
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="order-journal", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Grava o que ainda está na fila e fecha o banco."""
+        if not self._running:
+            return
+        self._running = False
+        self._queue.put(None)
+        if self._thread:
+            self._thread.join(timeout)
+        self._db.close()
+        self._db = None
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+            "avg_batch": round(self.written / self.batches, 2) if self.batches else 0.0,
+            "queue_depth": self.queue_depth(),
+        }
+
+    # ----------------------------------------------------------------- eventos
+
+    def record(self, kind: str, order_id: str, call_sid: str | None = None, **data):
+        """Não bloqueia: o JSON é montado na thread do diário, então `data`
+        não pode ser mutado depois (passar cópias, não listas da sessão)."""
+        if self._running:
+            self._queue.put((time.time(), kind, order_id, call_sid, data))
+
+    def order_created(self, session: CallSession):
+        self.record("created", session.order_id, session.call_sid, from_number=session.from_number)
+
+    def items_changed(self, session: CallSession):
+        self.record(
+            "items", session.order_id, session.call_sid,
+            items=[item.to_compact() for item in session.order_items],
+            total=session.order_total,
+        )
+
+    def payment_link_sent(self, session: CallSession):
+        self.record(
+            "payment_link", session.order_id, session.call_sid,
+            url=session.payment_link, link_id=session.payment_intent_id,
+        )
+
+    def payment_confirmed(self, session: CallSession, payment_intent_id: str | None = None):
+        self.record(
+            "payment_confirmed", session.order_id, session.call_sid,
+            payment_intent_id=payment_intent_id, total=session.order_total,
+        )
+
+    def print_status(self, order_id: str, station: str, status: str):
+        self.record("print", order_id, station=station, status=status)
+
+    # ------------------------------------------------------------------ writer
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            event = self._queue.get()
+            if event is None:
+                break
+            batch = [event]
+            # Group commit: tudo o que chegou enquanto o lote anterior gravava.
+            while len(batch) < self.batch_size:
+                try:
+                    event = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+            self._write(batch)
+
+    def _write(self, batch: list[tuple]):
+        rows = [
+            (ts, datetime.fromtimestamp(ts).strftime("%Y-%m-%d"), order_id, call_sid, kind,
+             json.dumps(data, ensure_ascii=False, separators=(",", ":")) if data else None)
+            for ts, kind, order_id, call_sid, data in batch
+        ]
+        try:
+            with self._db:
+                self._db.executemany(_INSERT, rows)
+            self.written += len(rows)
+            self.batches += 1
+        except sqlite3.Error as e:
+            self.failed += len(rows)
+            logger.error("[Journal] Falha ao gravar %s eventos: %s", len(rows), e)
+
+    # ---------------------------------------------------------------- consultas
+
+    def _query(self, where: str, params: tuple) -> list[dict]:
+        """Conexão própria por consulta: no WAL leitores não esperam o writer."""
+        db = sqlite3.connect(self.path)
+        try:
+            rows = db.execute(
+                f"SELECT ts, order_id, call_sid, kind, data FROM order_events WHERE {where} ORDER BY id",
+                params,
+            ).fetchall()
+        finally:
+            db.close()
+        return [
+            {"ts": ts, "order_id": order_id, "call_sid": call_sid, "kind": kind, **json.loads(data or "{}")}
+            for ts, order_id, call_sid, kind, data in rows
+        ]
+
+    def events_for_order(self, order_id: str) -> list[dict]:
+        return self._query("order_id = ?", (order_id,))
+
+    def events_for_call(self, call_sid: str) -> list[dict]:
+        return self._query("call_sid = ?", (call_sid,))
+
+    def events_on(self, day: str) -> list[dict]:
+        """`day` no formato YYYY-MM-DD (hora local)."""
+        return self._query("day = ?", (day,))
+
+    def open_orders(self, since: float) -> list[dict]:
+        """
+        Pedidos desde `since` que ainda precisam do processo: link enviado e
+        pagamento não confirmado (o webhook pode chegar depois do restart), ou
+        pago sem comanda no spool.
+        """
+        since_day = datetime.fromtimestamp(since).strftime("%Y-%m-%d")
+        pending = []
+        for order in _fold(self._query("day >= ? AND ts >= ?", (since_day, since))):
+            if order.get("payment_confirmed"):
+                if not order["printed"]:
+                    pending.append(order)
+            elif order.get("payment_link"):
+                pending.append(order)
+        return pending
+
+    def order_for_call(self, call_sid: str) -> dict | None:
+        """Último pedido da ligação, para quando a sessão já saiu do store."""
+        if not self._running:
+            return None
+        orders = _fold(self.events_for_call(call_sid))
+        return orders[-1] if orders else None
+
+
+def _fold(events: list[dict]) -> list[dict]:
+    """Eventos (em ordem) -> estado de cada pedido. Só pedidos com criação e itens no intervalo."""
+    orders: dict[str, dict] = {}
+    for event in events:
+        order = orders.setdefault(event["order_id"], {"order_id": event["order_id"], "printed": False})
+        kind = event["kind"]
+        if kind == "created":
+            order.update(call_sid=event["call_sid"], from_number=event["from_number"], created_at=event["ts"])
+        elif kind == "items":
+            order["items"] = event["items"]
+        elif kind == "payment_link":
+            order.update(payment_link=event["url"], link_id=event["link_id"])
+        elif kind == "payment_confirmed":
+            order["payment_confirmed"] = True
+        elif kind == "print" and event["status"] in ("queued", "printed"):
+            order["printed"] = True
+    return [order for order in orders.values() if "call_sid" in order and order.get("items")]
+
+
+def session_from_order(order: dict) -> CallSession:
+    """Sessão mínima reconstruída do diário — sem histórico de conversa."""
+    session = CallSession(order["call_sid"], order["from_number"])
+    session.order_id = order["order_id"]
+    session.order_items = [OrderItem.from_compact(i) for i in order["items"]]
+    session._recalculate_total()
+    session.payment_link = order.get("payment_link")
+    session.payment_intent_id = order.get("link_id")
+    session.payment_confirmed = order.get("payment_confirmed", False)
+    session.state = CallState.PAYMENT_CONFIRMED if session.payment_confirmed else CallState.PAYMENT_SENT
+    session.created_at = datetime.fromtimestamp(order["created_at"])
+    return session
+
+
+async def recover_orders(store) -> list[CallSession]:
+    """
+    Startup: devolve ao store os pedidos em aberto que não estão lá (o store
+    em memória some no restart). Retorna os já pagos que ainda precisam ser
+    impressos.
+    """
+    if not journal._running:
+        return []
+    since = time.time() - settings.journal_recovery_hours * 3600
+    orders = await asyncio.to_thread(journal.open_orders, since)
+    to_print: list[CallSession] = []
+    restored = 0
+    for order in orders:
+        if await store.get(order["call_sid"]) is not None:
+            continue
+        session = session_from_order(order)
+        await store.save(session)
+        restored += 1
+        if session.payment_confirmed:
+            to_print.append(session)
+    if restored:
+        logger.info("[Journal] %s pedidos em aberto recuperados (%s para imprimir)", restored, len(to_print))
+    return to_print
+
+
+journal = OrderJournal(settings.journal_path, settings.journal_batch_size, settings.journal_synchronous)
@@ -0,0 +1,634 @@
+"""
+Teste de carga — `python loadtest.py --ramp 1,10,25,50 -o resultado.json`.
+
+Sobe stand-ins locais da OpenAI, Stripe e Twilio com latência configurável,
+roda o app num subprocesso apontado para eles e dispara ligações simuladas
+do ConversationRelay (POST /voice/incoming + WebSocket /voice/ws) em degraus
+de concorrência. Tudo offline; o resultado é um JSON comparável entre commits.
+
+Latências aceitam "fixed:MS", "uniform:MIN:MAX" ou "lognormal:MEDIANA:SIGMA".
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import json
+import math
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import httpx
+import uvicorn
+import websockets
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from menu_index import normalize
+
+PAY = "<pagamento>"
+
+# Cada roteiro é uma ligação; PAY é o momento em que o cliente paga o link.
+SCRIPTS = [
+    [
+        "Meu nome é Ana",
+        "Quero um Filthy Onion e uma Coca-Cola",
+        "só isso",
+        "pode mandar",
+        PAY,
+        "obrigado tchau",
+    ],
+    [
+        "Aqui é o Bruno",
+        "O que vem no Guaca Filthy?",
+        "Então me vê dois Guaca Filthy e uma Onion Rings",
+        "e um molho bbq também",
+        "não",
+        "sim",
+        PAY,
+        "valeu tchau",
+    ],
+    [
+        "Oi, é a Carla",
+        "Vocês têm bebida sem açúcar?",
+        "Uma Coca-Cola Zero e um Double Filthy, por favor",
+        "e isso",
+        "pode sim",
+        PAY,
+        "não",
+        "obrigada tchau",
+    ],
+]
+
+_QUANTITIES = {"um": 1, "uma": 1, "dois": 2, "duas": 2, "tres": 3, "quatro": 4, "cinco": 5}
+_APP_ENV_DEFAULTS = {
+    "OPENAI_API_KEY": "sk-loadtest",
+    "STRIPE_SECRET_KEY": "sk_test_loadtest",
+    "STRIPE_WEBHOOK_SECRET": "whsec_loadtest",
+    "TWILIO_ACCOUNT_SID": "ACloadtest",
+    "TWILIO_AUTH_TOKEN": "loadtest",
+    "TWILIO_PHONE_NUMBER": "+5511900000000",
+    "PRINTER_TYPE": "dummy",
+    "SESSION_STORE": "memory",
+    "STRIPE_DEDUP_DB": "",
+}
+
+
+class Latency:
+    def __init__(self, spec: str):
+        kind, *params = spec.split(":")
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(p) for p in params]
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Distribuição desconhecida: {spec}")
+
+    def sample(self) -> float:
+        """Segundos."""
+        if self.kind == "fixed":
+            ms = self.params[0]
+        elif self.kind == "uniform":
+            ms = random.uniform(self.params[0], self.params[1])
+        else:
+            ms = random.lognormvariate(math.log(max(self.params[0], 0.001)), self.params[1])
+        return ms / 1000
+
+    def __str__(self):
+        return self.spec
+
+
+# ---------------------------------------------------------------- stand-ins
+
+
+class FakeModel:
+    """Responde no formato compacto {speech, action, ops} por regras simples."""
+
+    def __init__(self, menu_path: str):
+        with open(menu_path, encoding="utf-8") as f:
+            data = json.load(f)
+        keys = []
+        for category in data["categories"]:
+            for item in category["items"]:
+                key = re.sub(r"\s*\d+\s*ml$", "", normalize(item["name_pt"]))
+                keys.append((key, item["id"], item["name_pt"]))
+        # Mais longo primeiro: "coca cola zero" antes de "coca cola".
+        self.keys = sorted(keys, key=lambda k: len(k[0]), reverse=True)
+
+    def match_items(self, transcript: str) -> list[tuple[str, int, str]]:
+        text = f" {normalize(transcript)} "
+        found = []
+        for key, item_id, name in self.keys:
+            pos = text.find(f" {key} ")
+            if pos < 0:
+                continue
+            before = text[:pos].split()
+            word = before[-1] if before else ""
+            qty = int(word) if word.isdigit() else _QUANTITIES.get(word, 1)
+            found.append((item_id, qty, name))
+            text = text[:pos] + " " * (len(key) + 2) + text[pos + len(key) + 2:]
+        return found
+
+    def turn(self, messages: list[dict]) -> dict:
+        transcript = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+        text = normalize(transcript)
+        if "?" in transcript or text.startswith(("o que", "tem ", "voces tem")):
+            speech = "Boa pergunta! É um dos mais pedidos da casa, vem bem servido. Quer adicionar ao pedido?"
+            return {"speech": speech, "action": "none", "ops": []}
+        items = self.match_items(transcript)
+        if items:
+            spoken = " e ".join(f"{qty} {name}" for _, qty, name in items)
+            return {
+                "speech": f"Anotado: {spoken}. Mais alguma coisa?",
+                "action": "update_order",
+                "ops": [{"op": "add", "id": item_id, "qty": qty} for item_id, qty, _ in items],
+            }
+        if text.startswith(("meu nome", "aqui e", "oi e", "sou ")):
+            speech = "Prazer! O que você vai querer hoje?"
+        else:
+            speech = "Certo! Posso ajudar com mais alguma coisa?"
+        return {"speech": speech, "action": "none", "ops": []}
+
+
+class FakeServices:
+    """OpenAI, Stripe e Twilio num único app local, cada um com sua latência."""
+
+    def __init__(self, model: FakeModel, llm_ttft: Latency, llm_chunk: Latency,
+                 stripe: Latency, twilio: Latency, chunk_chars: int = 12):
+        self.model = model
+        self.llm_ttft = llm_ttft
+        self.llm_chunk = llm_chunk
+        self.stripe = stripe
+        self.twilio = twilio
+        self.chunk_chars = chunk_chars
+        self.requests: dict[str, int] = {}
+        self.app = self._build_app()
+
+    def _count(self, name: str):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/v1/chat/completions")
+        async def chat_completions(request: Request):
+            self._count("openai_chat")
+            body = await request.json()
+            if "response_format" in body:
+                content = json.dumps(self.model.turn(body["messages"]), ensure_ascii=False)
+            else:
+                content = "Cliente se apresentou e fez o pedido."
+            usage = {
+                "prompt_tokens": sum(len(m["content"]) for m in body["messages"]) // 4,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": 0,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            }
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+            await asyncio.sleep(self.llm_ttft.sample())
+
+            if not body.get("stream"):
+                return {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                }
+
+            def chunk(choices, usage=None) -> str:
+                payload = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body["model"],
+                    "choices": choices,
+                    "usage": usage,
+                }
+                return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+            async def events():
+                for start in range(0, len(content), self.chunk_chars):
+                    if start:
+                        await asyncio.sleep(self.llm_chunk.sample())
+                    delta = {"content": content[start:start + self.chunk_chars]}
+                    yield chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+                yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    yield chunk([], usage)
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        @app.get("/v1/models/{model}")
+        async def retrieve_model(model: str):
+            self._count("openai_models")
+            return {"id": model, "object": "model", "created": 0, "owned_by": "loadtest"}
+
+        @app.post("/v1/payment_links")
+        async def create_payment_link():
+            self._count("stripe_create")
+            await asyncio.sleep(self.stripe.sample())
+            link_id = f"plink_{uuid.uuid4().hex[:16]}"
+            return {
+                "id": link_id,
+                "object": "payment_link",
+                "active": True,
+                "url": f"https://buy.stripe.test/{link_id}",
+            }
+
+        @app.post("/v1/payment_links/{link_id}")
+        async def modify_payment_link(link_id: str):
+            self._count("stripe_modify")
+            await asyncio.sleep(self.stripe.sample())
+            return {"id": link_id, "object": "payment_link", "active": False, "url": ""}
+
+        @app.post("/2010-04-01/Accounts/{account_sid}/Messages.json")
+        async def create_message(account_sid: str):
+            self._count("twilio_sms")
+            await asyncio.sleep(self.twilio.sample())
+            return JSONResponse(
+                {"sid": f"SM{uuid.uuid4().hex}", "status": "queued", "account_sid": account_sid},
+                status_code=201,
+            )
+
+        return app
+
+
+class ThreadedServer:
+    """uvicorn numa thread própria: a latência dos fakes não disputa o loop do driver."""
+
+    def __init__(self, app, port: int):
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=port, log_level="warning", lifespan="off",
+        ))
+        self.thread = threading.Thread(target=self.server.run, name="fakes", daemon=True)
+
+    def start(self, timeout: float = 10.0):
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError("Servidor fake não subiu")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+
+# ------------------------------------------------------------ app sob teste
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(port: int, fakes_url: str, workdir: str, extra_env: dict[str, str]) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update(_APP_ENV_DEFAULTS)
+    env.update({
+        "BASE_URL": f"http://127.0.0.1:{port}",
+        "OPENAI_BASE_URL": f"{fakes_url}/v1",
+        "STRIPE_API_BASE": fakes_url,
+        "TWILIO_API_BASE": fakes_url,
+        "PRINT_SPOOL_DIR": os.path.join(workdir, "spool"),
+        "SESSION_ARCHIVE_DIR": os.path.join(workdir, "archive"),
+        "JOURNAL_PATH": os.path.join(workdir, "orders.db"),
+    })
+    env.update(extra_env)
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app",
+         "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"App saiu com código {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return process
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("App não respondeu /health em 30s")
+
+
+def stop_app(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def _rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class ServerProbe:
+    """
+    Thread que mede o RTT do /health e o RSS do app. O /health não faz I/O,
+    então o RTT acima da linha de base ociosa é atraso do event loop do app.
+    """
+
+    def __init__(self, url: str, pid: int, interval: float):
+        self.url = url
+        self.pid = pid
+        self.interval = interval
+        self.samples: list[tuple[float, float, int]] = []  # (t, rtt s, rss kB)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="probe", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        with httpx.Client(timeout=10) as client:
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                try:
+                    client.get(f"{self.url}/health")
+                    rtt = time.perf_counter() - start
+                except httpx.HTTPError:
+                    rtt = float("nan")
+                with self._lock:
+                    self.samples.append((time.monotonic(), rtt, _rss_kb(self.pid)))
+                self._stop.wait(self.interval)
+
+    def since(self, t: float) -> list[tuple[float, float, int]]:
+        with self._lock:
+            return [s for s in self.samples if s[0] >= t]
+
+
+# --------------------------------------------------------- cliente simulado
+
+
+def _signed_webhook(call_sid: str, secret: str) -> tuple[bytes, str]:
+    payload = json.dumps({
+        "id": f"evt_{uuid.uuid4().hex[:24]}",
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {
+            "id": f"cs_test_{uuid.uuid4().hex[:24]}",
+            "object": "checkout.session",
+            "metadata": {"call_sid": call_sid},
+        }},
+    }).encode()
+    timestamp = int(time.time())
+    signature = hmac.new(secret.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return payload, f"t={timestamp},v1={signature}"
+
+
+async def _read_turn(ws, timeout: float) -> dict:
+    """Lê frames até o "last: true" (ou "end"). Tempos a partir de agora."""
+    start = time.perf_counter()
+    ttft = None
+    ended = False
+    while True:
+        data = json.loads(await asyncio.wait_for(ws.recv(), timeout))
+        if data.get("type") == "end":
+            ended = True
+            break
+        if data.get("type") != "text":
+            continue
+        if ttft is None and data.get("token"):
+            ttft = time.perf_counter() - start
+        if data.get("last"):
+            break
+    latency = time.perf_counter() - start
+    return {"ttft": ttft if ttft is not None else latency, "latency": latency, "ended": ended}
+
+
+class CallSimulator:
+    def __init__(self, app_url: str, http: httpx.AsyncClient, args):
+        self.app_url = app_url
+        self.ws_url = app_url.replace("http://", "ws://") + "/voice/ws"
+        self.http = http
+        self.think = Latency(args.think)
+        self.pay_delay = Latency(args.pay_delay)
+        self.timeout = args.turn_timeout
+        self.secret = _APP_ENV_DEFAULTS["STRIPE_WEBHOOK_SECRET"]
+
+    async def run(self, script: list[str]) -> dict:
+        call_sid = f"CA{uuid.uuid4().hex}"
+        caller = f"+55119{random.randint(10000000, 99999999)}"
+        result = {"turns": [], "payment": None, "error": None}
+        start = time.perf_counter()
+        try:
+            response = await self.http.post("/voice/incoming", data={
+                "CallSid": call_sid, "From": caller, "To": _APP_ENV_DEFAULTS["TWILIO_PHONE_NUMBER"],
+            })
+            response.raise_for_status()
+            async with websockets.connect(self.ws_url, max_size=None, open_timeout=self.timeout) as ws:
+                await ws.send(json.dumps({"type": "setup", "callSid": call_sid, "from": caller}))
+                for line in script:
+                    # Tempo do cliente falando (ou ouvindo a saudação, no primeiro turno).
+                    await asyncio.sleep(self.think.sample())
+                    if line == PAY:
+                        result["payment"] = await self._pay(ws, call_sid)
+                        continue
+                    await ws.send(json.dumps({"type": "prompt", "voicePrompt": line, "lang": "pt-BR", "last": True}))
+                    turn = await _read_turn(ws, self.timeout)
+                    result["turns"].append(turn)
+                    if turn["ended"]:
+                        break
+        except (websockets.exceptions.ConnectionClosed, asyncio.TimeoutError, httpx.HTTPError, OSError) as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["duration"] = time.perf_counter() - start
+        return result
+
+    async def _pay(self, ws, call_sid: str) -> float:
+        """Webhook assinado e tempo até a Duda anunciar o pagamento."""
+        await asyncio.sleep(self.pay_delay.sample())
+        payload, signature = _signed_webhook(call_sid, self.secret)
+        start = time.perf_counter()
+        response = await self.http.post(
+            "/payment/webhook", content=payload,
+            headers={"stripe-signature": signature, "content-type": "application/json"},
+        )
+        response.raise_for_status()
+        await _read_turn(ws, self.timeout)
+        return time.perf_counter() - start
+
+
+# -------------------------------------------------------------- relatório
+
+
+def _percentiles(values: list[float], scale: float = 1000.0) -> dict:
+    values = sorted(v for v in values if v == v)
+    if not values:
+        return {"n": 0}
+
+    def rank(p):
+        return round(values[min(len(values) - 1, max(0, math.ceil(p * len(values)) - 1))] * scale, 2)
+
+    return {
+        "n": len(values),
+        "p50": rank(0.50),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "max": round(values[-1] * scale, 2),
+    }
+
+
+def _git_revision() -> dict:
+    # Do repositório do loadtest, não do diretório de onde ele foi chamado.
+    repo = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=repo).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                                    capture_output=True, text=True, cwd=repo).stdout.strip())
+    except OSError:
+        return {}
+    return {"commit": commit, "dirty": dirty}
+
+
+async def run_stage(concurrency: int, simulator: CallSimulator, probe: ServerProbe,
+                    fakes: FakeServices, spread: float, idle_rtt: float) -> dict:
+    requests_before = dict(fakes.requests)
+    started = time.monotonic()
+    rss_before = _rss_kb(probe.pid)
+
+    async def delayed(i: int):
+        await asyncio.sleep(spread * i / concurrency)
+        return await simulator.run(SCRIPTS[i % len(SCRIPTS)])
+
+    calls = await asyncio.gather(*(delayed(i) for i in range(concurrency)))
+    duration = time.monotonic() - started
+    samples = probe.since(started)
+
+    turns = [t for c in calls for t in c["turns"]]
+    rss_peak = max([s[2] for s in samples] + [_rss_kb(probe.pid)])
+    return {
+        "concurrency": concurrency,
+        "calls": len(calls),
+        "errors": sum(1 for c in calls if c["error"]),
+        "error_samples": sorted({c["error"] for c in calls if c["error"]})[:5],
+        "duration_s": round(duration, 2),
+        "turn_latency_ms": _percentiles([t["latency"] for t in turns]),
+        "ttft_ms": _percentiles([t["ttft"] for t in turns]),
+        "payment_confirm_ms": _percentiles([c["payment"] for c in calls if c["payment"] is not None]),
+        "call_duration_s": _percentiles([c["duration"] for c in calls], scale=1.0),
+        "loop_lag_ms": _percentiles([max(0.0, s[1] - idle_rtt) for s in samples]),
+        "rss_mb_before": round(rss_before / 1024, 1),
+        "rss_mb_peak": round(rss_peak / 1024, 1),
+        "rss_kb_per_call": round(max(0, rss_peak - rss_before) / concurrency, 1),
+        "fake_requests": {k: v - requests_before.get(k, 0) for k, v in fakes.requests.items()},
+    }
+
+
+async def drive(args, app_url: str, probe: ServerProbe, fakes: FakeServices) -> tuple[list[dict], float]:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=64)
+    async with httpx.AsyncClient(base_url=app_url, timeout=args.turn_timeout, limits=limits) as http:
+        simulator = CallSimulator(app_url, http, args)
+
+        await asyncio.sleep(args.idle)
+        idle = probe.since(0)
+        idle_rtt = sorted(s[1] for s in idle)[len(idle) // 2] if idle else 0.0
+
+        stages = []
+        for concurrency in args.ramp:
+            stage = await run_stage(concurrency, simulator, probe, fakes, args.spread, idle_rtt)
+            stages.append(stage)
+            print(
+                f"[loadtest] {concurrency:>4} chamadas | turno p50/p99 "
+                f"{stage['turn_latency_ms'].get('p50')}/{stage['turn_latency_ms'].get('p99')} ms | "
+                f"lag p99 {stage['loop_lag_ms'].get('p99')} ms | erros {stage['errors']}",
+                file=sys.stderr,
+            )
+            await asyncio.sleep(args.cooldown)
+        return stages, idle_rtt
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ramp", type=lambda s: [int(n) for n in s.split(",")], default=[1, 5, 10, 25])
+    parser.add_argument("--spread", type=float, default=1.0, help="segundos para iniciar as chamadas de um degrau")
+    parser.add_argument("--cooldown", type=float, default=2.0)
+    parser.add_argument("--idle", type=float, default=2.0, help="amostragem ociosa antes do primeiro degrau")
+    parser.add_argument("--llm-ttft", default="lognormal:450:0.35")
+    parser.add_argument("--llm-chunk", default="lognormal:15:0.5", help="intervalo entre chunks do stream")
+    parser.add_argument("--stripe", default="lognormal:350:0.3")
+    parser.add_argument("--twilio", default="lognormal:200:0.3")
+    parser.add_argument("--think", default="lognormal:800:0.3", help="pausa do cliente entre turnos")
+    parser.add_argument("--pay-delay", default="lognormal:1500:0.3", help="tempo até o cliente pagar o link")
+    parser.add_argument("--turn-timeout", type=float, default=30.0)
+    parser.add_argument("--probe-interval", type=float, default=0.05)
+    parser.add_argument("--menu", default="menu.json")
+    parser.add_argument("--app-env", action="append", default=[], metavar="CHAVE=VALOR",
+                        help="variável extra para o app, ex: OPENAI_STREAM=false")
+    parser.add_argument("-o", "--output", help="arquivo JSON (padrão: só stdout)")
+    args = parser.parse_args()
+
+    latencies = {name: Latency(getattr(args, name)) for name in ("llm_ttft", "llm_chunk", "stripe", "twilio")}
+    extra_env = dict(item.split("=", 1) for item in args.app_env)
+
+    fakes = FakeServices(FakeModel(args.menu), **latencies)
+    fakes_port, app_port = _free_port(), _free_port()
+    fake_server = ThreadedServer(fakes.app, fakes_port)
+    fake_server.start()
+
+    with tempfile.TemporaryDirectory(prefix="loadtest-") as workdir:
+        app = start_app(app_port, f"http://127.0.0.1:{fakes_port}", workdir, extra_env)
+        app_url = f"http://127.0.0.1:{app_port}"
+        probe = ServerProbe(app_url, app.pid, args.probe_interval)
+        probe.start()
+        try:
+            stages, idle_rtt = asyncio.run(drive(args, app_url, probe, fakes))
+        finally:
+            probe.stop()
+            stop_app(app)
+            fake_server.stop()
+
+    report = {
+        "loadtest": "calls",
+        **_git_revision(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {
+            "ramp": args.ramp,
+            "spread_s": args.spread,
+            "think": args.think,
+            "pay_delay": args.pay_delay,
+            "app_env": extra_env,
+            **{name: str(latency) for name, latency in latencies.items()},
+        },
+        "idle_health_rtt_ms": round(idle_rtt * 1000, 3),
+        "stages": stages,
+    }
+    output = json.dumps(report, ensure_ascii=False)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Logging fora do event loop — os handlers só enfileiram o registro; a
+formatação (%-args, JSON, traceback) e a escrita acontecem numa thread
+própria (QueueListener). call_sid e order_id entram sozinhos em cada
+registro via contextvars.
+
+Logs verbosos de turno (transcrição, fala, tokens) levam `extra=VERBOSE` e
+passam por amostragem por nível, decidida por ligação: uma ligação
+amostrada aparece inteira, as outras não aparecem.
+"""
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+import zlib
+from config import get_settings
+
+settings = get_settings()
+
+call_sid_var: contextvars.ContextVar[str | None] = contextvars.ContextVar("call_sid", default=None)
+order_id_var: contextvars.ContextVar[str | None] = contextvars.ContextVar("order_id", default=None)
+
+VERBOSE = {"verbose": True}
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {
+    "message", "asctime", "call_sid", "order_id", "verbose", "context", "taskName",
+}
+
+_listener: logging.handlers.QueueListener | None = None
+dropped = 0
+
+
+def bind_call(call_sid: str | None, order_id: str | None = None):
+    """Vale para a task atual e para as que ela criar daqui em diante."""
+    call_sid_var.set(call_sid)
+    order_id_var.set(order_id)
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """
+    Ao contrário do QueueHandler padrão, não formata nada na thread que
+    loga: só copia o contexto e enfileira. msg/args são formatados pelo
+    listener, então os args precisam ser valores que não mudam depois
+    (str, números) — é o que o código de turno passa.
+    """
+
+    def __init__(self, q: queue.Queue, sample_rates: dict[str, float]):
+        super().__init__(q)
+        self.sample_rates = {logging.getLevelName(k.upper()): v for k, v in sample_rates.items()}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.call_sid = call_sid_var.get()
+        record.order_id = order_id_var.get()
+        if getattr(record, "verbose", False) and record.levelno < logging.WARNING:
+            rate = self.sample_rates.get(record.levelno, 1.0)
+            if rate < 1.0 and not _sampled(record.call_sid, rate):
+                return False
+        return super().filter(record)
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+
+def _sampled(call_sid: str | None, rate: float) -> bool:
+    if call_sid is None:
+        return (time.perf_counter_ns() % 10_000) < rate * 10_000
+    return (zlib.crc32(call_sid.encode()) % 10_000) < rate * 10_000
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "call_sid", None):
+            data["call_sid"] = record.call_sid
+        if getattr(record, "order_id", None):
+            data["order_id"] = record.order_id
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                data[key] = value
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s [%(levelname)s] %(name)s%(context)s: %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        call_sid = getattr(record, "call_sid", None)
+        record.context = f" [{call_sid}]" if call_sid else ""
+        return super().format(record)
+
+
+def setup_logging():
+    """Troca o basicConfig: root e uvicorn passam a escrever pela fila."""
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if settings.log_format == "json" else TextFormatter())
+
+    log_queue: queue.Queue = queue.Queue(maxsize=settings.log_queue_size)
+    handler = ContextQueueHandler(log_queue, settings.log_sample_rates)
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(settings.log_level.upper())
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers = []
+        uvicorn_logger.propagate = True
+
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Esvazia a fila antes de sair."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,19 +1,92 @@
-import logging
+import asyncio
 import os
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from handler import router as voice_router
-from stripe_handler import router as payment_router
+from fastapi.responses import PlainTextResponse
+from handler import router as voice_router, render_twiml
+from stripe_handler import router as payment_router, webhook_processor
+from sms import router as sms_router, dispatcher as sms_dispatcher
+from menu import refresh_catalog, watch_menu
+from session import get_store, pending_payment_waits, sweep_sessions
+from comanda import get_print_status, journal_print_status, print_comanda, spool_owner, spool_stats, start_spools, stop_spools
+from config import get_settings
+from intents import classifier
+from prompt import prompt_builder
+from response_cache import response_cache
+from journal import journal, recover_orders
+import logs
+import metrics
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
+logs.setup_logging()
+settings = get_settings()
+
+metrics.Gauge("voicemenu_active_calls", "Ligações com WebSocket aberto.", metrics.active_calls)
+metrics.Gauge(
+    "voicemenu_stored_sessions",
+    "Sessões no store em memória desta instância.",
+    lambda: len(get_store()) if hasattr(get_store(), "__len__") else {},
+)
+metrics.Gauge("voicemenu_pending_payment_waits", "Ligações esperando o webhook de pagamento.", pending_payment_waits)
+metrics.Gauge(
+    "voicemenu_print_queue_depth",
+    "Comandas na fila de cada impressora.",
+    lambda: {s["printer"]: s["queue_depth"] for s in spool_stats()},
+    ("printer",),
+)
+metrics.Gauge("voicemenu_sms_queue_depth", "SMS esperando envio.", lambda: sms_dispatcher.queue_depth())
+metrics.Gauge("voicemenu_webhook_queue_depth", "Eventos da Stripe esperando processamento.", lambda: webhook_processor.queue_depth())
+metrics.Gauge("voicemenu_prompt_cached_ratio", "Fração dos tokens de prompt servida do cache.", lambda: prompt_builder.stats()["cached_ratio"])
+metrics.Gauge("voicemenu_response_cache_hit_ratio", "Acertos do cache de respostas.", lambda: response_cache.stats()["hit_ratio"])
+metrics.Gauge("voicemenu_response_cache_entries", "Respostas no cache.", lambda: response_cache.stats()["entries"])
+metrics.Gauge(
+    "voicemenu_fast_path_hits",
+    "Turnos respondidos pelo atalho local, por intenção.",
+    lambda: classifier.stats()["by_intent"],
+    ("intent",),
 )
+metrics.Gauge("voicemenu_journal_queue_depth", "Eventos do diário de pedidos esperando gravação.", journal.queue_depth)
+metrics.Gauge("voicemenu_log_dropped", "Registros de log descartados com a fila cheia.", lambda: logs.dropped)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    refresh_catalog()
+    render_twiml()
+    await asyncio.to_thread(journal.start)
+    await asyncio.to_thread(start_spools)
+    await sms_dispatcher.start()
+    await webhook_processor.start()
+    if spool_owner():
+        # Um worker só: os outros imprimiriam os mesmos pedidos de novo.
+        for session in await recover_orders(get_store()):
+            await print_comanda(session)
+    background = [
+        asyncio.create_task(watch_menu()),
+        asyncio.create_task(sweep_sessions()),
+        asyncio.create_task(get_store().listen()),
+        asyncio.create_task(metrics.monitor_event_loop(settings.metrics_loop_lag_interval)),
+    ]
+    if metrics.profiler:
+        metrics.profiler.start()
+    yield
+    if metrics.profiler:
+        metrics.profiler.stop()
+    for task in background:
+        task.cancel()
+    await webhook_processor.stop()
+    await sms_dispatcher.stop()
+    await get_store().close()
+    await asyncio.to_thread(stop_spools)
+    await asyncio.to_thread(journal.stop)
+    logs.stop_logging()
+
 
 app = FastAPI(
     title="Restaurant Voice AI",
     description="AI-powered voice ordering system for restaurants",
     version="2.0.0",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -25,6 +98,7 @@ app.add_middleware(
 
 app.include_router(voice_router)
 app.include_router(payment_router)
+app.include_router(sms_router)
 
 
 @app.get("/")
@@ -37,6 +111,32 @@ async def health():
     return {"status": "healthy"}
 
 
+@app.get("/orders/{order_id}/print")
+async def order_print_status(order_id: str):
+    """Status da comanda por estação: queued, printed ou failed."""
+    if spool_owner():
+        status = get_print_status(order_id)
+    else:
+        # O spool imprime em outro worker; o diário é compartilhado.
+        status = await asyncio.to_thread(journal_print_status, order_id) or get_print_status(order_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Pedido sem comanda")
+    return {"order_id": order_id, **status}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/metrics/profile")
+async def profile(reset: bool = False):
+    """Pilhas do event loop em formato folded (flamegraph.pl / speedscope)."""
+    if metrics.profiler is None:
+        raise HTTPException(status_code=404, detail="Profiler desligado (PROFILER_INTERVAL=0)")
+    return PlainTextResponse(metrics.profiler.folded(reset))
+
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8080))
@@ -1,34 +1,130 @@
+"""
+Cardápio — catálogo indexado, com recarga a quente quando o menu.json muda.
+"""
+import asyncio
+import hashlib
 import json
-from functools import lru_cache
+import logging
+import os
 from config import get_settings
+from menu_index import MenuIndex
 
-@lru_cache()
-def load_menu() -> dict:
+logger = logging.getLogger(__name__)
+
+
+class MenuCatalog:
+    """Snapshot imutável do cardápio. Nunca é alterado depois de construído."""
+
+    def __init__(self, data: dict, version: str, mtime: float = 0.0):
+        self.data = data
+        self.version = version
+        self.mtime = mtime
+        self.restaurant: dict = data["restaurant"]
+        self.items: dict[str, dict] = {}
+        self.categories: dict[str, list[dict]] = {}
+        self.item_category: dict[str, str] = {}
+
+        for category in data["categories"]:
+            cat_name = category.get("name_pt", "")
+            self.categories[cat_name] = category["items"]
+            for item in category["items"]:
+                self.items[item["id"]] = item
+                self.item_category[item["id"]] = cat_name
+
+        self.prompt_text = self._render_prompt()
+        self.compact_text = self._render_prompt(with_descriptions=False)
+        self.detail_lines = {item_id: self._detail_line(item) for item_id, item in self.items.items()}
+        self.index = MenuIndex(self.items, self.item_category)
+
+    @classmethod
+    def from_file(cls, path: str) -> "MenuCatalog":
+        with open(path, "rb") as f:
+            # mtime antes de ler: se o arquivo mudar no meio, o próximo reload pega.
+            mtime = os.fstat(f.fileno()).st_mtime
+            raw = f.read()
+        version = hashlib.sha256(raw).hexdigest()[:12]
+        return cls(json.loads(raw), version, mtime)
+
+    def _render_prompt(self, with_descriptions: bool = True) -> str:
+        lines = []
+        lines.append(f"=== CARDÁPIO - {self.restaurant['name']} ===\n")
+        for cat_name, items in self.categories.items():
+            lines.append(f"\n[{cat_name.upper()}]")
+            for item in items:
+                if with_descriptions:
+                    lines.append(self._detail_line(item))
+                else:
+                    lines.append(f"  - {item.get('name_pt', '')} (ID: {item['id']}): R$ {item['price']:.2f}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _detail_line(item: dict) -> str:
+        name = item.get("name_pt", "")
+        desc = item.get("description_pt", "")
+        return f"  - {name} (ID: {item['id']}): R$ {item['price']:.2f} — {desc}"
+
+    def relevant_details(self, text: str, order_item_ids: list[str], limit: int) -> str:
+        """Linhas completas (com descrição) só dos itens citados no turno ou já no pedido."""
+        selected = self.index.search(text, limit)
+        selected += [i for i in order_item_ids if i in self.items and i not in selected]
+        return "\n".join(self.detail_lines[i] for i in selected)
+
+
+_catalog: MenuCatalog | None = None
+
+
+def get_catalog() -> MenuCatalog:
+    """Caminho quente: só lê a referência atual. Quem precisa de consistência
+    durante um turno inteiro deve guardar o objeto retornado."""
+    catalog = _catalog
+    if catalog is None:
+        catalog = refresh_catalog()
+    return catalog
+
+
+def refresh_catalog() -> MenuCatalog:
+    """Recarrega o menu.json se o mtime mudou e troca o catálogo atomicamente."""
+    global _catalog
+    settings = get_settings()
+    current = _catalog
+    try:
+        mtime = os.stat(settings.menu_path).st_mtime
+        if current is not None and mtime == current.mtime:
+            return current
+        catalog = MenuCatalog.from_file(settings.menu_path)
+    except (OSError, ValueError, KeyError) as e:
+        if current is None:
+            raise
+        logger.error("[Menu] Falha ao recarregar %s, mantendo versão %s: %s", settings.menu_path, current.version, e)
+        return current
+
+    if current is None or catalog.version != current.version:
+        logger.info("[Menu] Cardápio carregado: versão %s, %s itens", catalog.version, len(catalog.items))
+    _catalog = catalog
+    return catalog
+
+
+async def watch_menu():
     settings = get_settings()
-    with open(settings.menu_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    while True:
+        await asyncio.sleep(settings.menu_reload_interval)
+        try:
+            await asyncio.to_thread(refresh_catalog)
+        except Exception as e:
+            logger.error("[Menu] Erro no watcher do cardápio: %s", e)
+
+
+def load_menu() -> dict:
+    return get_catalog().data
+
+def get_menu_version() -> str:
+    return get_catalog().version
 
 def get_menu_for_ai(language: str = "pt") -> str:
-    menu = load_menu()
-    lines = []
-    lines.append(f"=== CARDÁPIO - {menu['restaurant']['name']} ===\n")
-    for category in menu["categories"]:
-        cat_name = category.get("name_pt", "")
-        lines.append(f"\n[{cat_name.upper()}]")
-        for item in category["items"]:
-            name = item.get("name_pt", "")
-            desc = item.get("description_pt", "")
-            price = item["price"]
-            lines.append(f"  - {name} (ID: {item['id']}): R$ {price:.2f} — {desc}")
-    return "\n".join(lines)
+    return get_catalog().prompt_text
 
 def find_item_by_id(item_id: str) -> dict | None:
-    menu = load_menu()
-    for category in menu["categories"]:
-        for item in category["items"]:
-            if item["id"] == item_id:
-                return item
-    return None
+    return get_catalog().items.get(item_id)
 
 def get_restaurant_info() -> dict:
-    return load_menu()["restaurant"]
+    return get_catalog().restaurant
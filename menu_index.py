@@ -0,0 +1,127 @@
+"""
+Índice de busca do cardápio — escolhe os itens relevantes para o turno a
+partir da transcrição, tolerando acentos e erros de ASR em PT-BR
+(tokens exatos, trigramas e uma chave fonética simplificada).
+"""
+import math
+import re
+import unicodedata
+
+STOPWORDS = {
+    "com", "sem", "uma", "uns", "umas", "para", "pra", "por", "que", "quero",
+    "queria", "gostaria", "mais", "tem", "vocês", "voces", "qual", "quanto",
+    "dos", "das", "num", "numa", "nos", "nas", "ele", "ela", "isso", "esse",
+    "essa", "the", "and", "pode", "ver", "ter", "vou", "dois", "duas", "tres",
+}
+
+# Ordem importa: dígrafos antes das letras isoladas.
+_PHONETIC_RULES = [
+    (r"th", "t"), (r"ph", "f"), (r"sh|ch|x", "x"), (r"lh", "li"), (r"nh", "ni"),
+    (r"ss|ç", "s"), (r"c(?=[ei])", "s"), (r"qu|q|c|k", "k"), (r"w", "v"),
+    (r"y", "i"), (r"z", "s"), (r"h", ""), (r"(.)\1+", r"\1"),
+]
+# Em tokens curtos o esqueleto consonantal colide demais ("ser" e "zero" -> "sr").
+PHONETIC_MIN_LEN = 4
+
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    text = re.sub(r"[^a-z0-9 ]+", " ", text)
+    return " ".join(text.split())
+
+
+def tokens(text: str) -> list[str]:
+    return [t for t in normalize(text).split() if len(t) >= 3 and t not in STOPWORDS]
+
+
+def phonetic(token: str) -> str:
+    key = token
+    for pattern, repl in _PHONETIC_RULES:
+        key = re.sub(pattern, repl, key)
+    # Esqueleto consonantal: ASR erra mais as vogais de nomes em inglês.
+    return key[0] + re.sub(r"[aeiou]", "", key[1:]) if key else key
+
+
+def trigrams(token: str) -> set[str]:
+    padded = f" {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class MenuIndex:
+    def __init__(self, items: dict[str, dict], item_category: dict[str, str]):
+        self._exact: dict[str, set[str]] = {}
+        self._phonetic: dict[str, set[str]] = {}
+        self._trigrams: dict[str, set[str]] = {}
+        self._token_grams: dict[str, set[str]] = {}
+        self._description: dict[str, set[str]] = {}
+        self._category_items: dict[str, set[str]] = {}
+
+        for item_id, item in items.items():
+            for token in tokens(item.get("name_pt", "")):
+                self._exact.setdefault(token, set()).add(item_id)
+                if len(token) >= PHONETIC_MIN_LEN:
+                    self._phonetic.setdefault(phonetic(token), set()).add(item_id)
+                grams = self._token_grams.setdefault(token, trigrams(token))
+                for gram in grams:
+                    self._trigrams.setdefault(gram, set()).add(token)
+            for token in tokens(item.get("description_pt", "")):
+                self._description.setdefault(token, set()).add(item_id)
+        for item_id, category in item_category.items():
+            for token in tokens(category):
+                self._category_items.setdefault(token, set()).add(item_id)
+                # "bebida" também acha "Bebidas"
+                self._category_items.setdefault(token.rstrip("s"), set()).add(item_id)
+
+        self._total = max(len(items), 1)
+
+    def _idf(self, item_ids: set[str]) -> float:
+        # Peso por raridade: "filthy" está em quase todo item e quase não discrimina.
+        return math.log(1 + self._total / len(item_ids))
+
+    def search(
+        self, text: str, limit: int = 6, min_similarity: float = 0.45, min_ratio: float = 0.4,
+        descriptions: bool = True,
+    ) -> list[str]:
+        """`descriptions=False`: só itens nomeados (nome ou categoria), não os que
+        apenas mencionam o termo na descrição — "é vegano?" não nomeia item nenhum."""
+        scores: dict[str, float] = {}
+
+        def add(item_ids, weight):
+            score = weight * self._idf(item_ids)
+            for item_id in item_ids:
+                scores[item_id] = scores.get(item_id, 0.0) + score
+
+        query = tokens(text)
+        for token in query:
+            if descriptions and token in self._description:
+                add(self._description[token], 0.5)
+            if token in self._exact:
+                add(self._exact[token], 3.0)
+                continue
+            if len(token) >= PHONETIC_MIN_LEN:
+                key = phonetic(token)
+                if key in self._phonetic and len(key) >= 2:
+                    add(self._phonetic[key], 2.0)
+                    continue
+            grams = trigrams(token)
+            candidates = {t for g in grams for t in self._trigrams.get(g, ())}
+            for candidate in candidates:
+                other = self._token_grams[candidate]
+                similarity = len(grams & other) / len(grams | other)
+                if similarity >= min_similarity:
+                    add(self._exact[candidate], 2.0 * similarity)
+
+        ranked = []
+        if scores:
+            best = max(scores.values())
+            ranked = sorted(
+                (i for i in scores if scores[i] >= best * min_ratio),
+                key=lambda i: scores[i], reverse=True,
+            )[:limit]
+
+        for token in query:
+            category_items = self._category_items.get(token) or self._category_items.get(token.rstrip("s"))
+            if category_items:
+                ranked.extend(i for i in sorted(category_items) if i not in ranked)
+        return ranked
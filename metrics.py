@@ -0,0 +1,263 @@
+"""
+Métricas em formato Prometheus — histogramas de latência por etapa do turno
+("spans"), contadores e gauges lidos na hora da coleta. Tudo em memória e
+barato no caminho quente: observar um valor é um bisect e três somas.
+"""
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+from collections import Counter as _Tally
+from config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Latência em segundos: de poucos ms (parse, prompt) até a espera do LLM.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+_registry: list = []
+
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series: dict[tuple, list] = {}  # labels -> [contagens por bucket, soma, total]
+        self._lock = threading.Lock()  # a impressão observa de outra thread
+        _registry.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(s[0]), s[1], s[2]) for labels, s in self._series.items()]
+        for labels, counts, total, count in snapshot:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                label_str = _labels(self.labelnames + ("le",), labels + (_number(bound),))
+                lines.append(f"{self.name}_bucket{label_str} {cumulative}")
+            label_str = _labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_str} {total}")
+            lines.append(f"{self.name}_count{label_str} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Valor lido na coleta: `fn` retorna um número ou um dict {labels: valor}."""
+
+    def __init__(self, name: str, help: str, fn, labelnames: tuple = ()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def collect(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            logger.warning("[Metrics] Gauge %s falhou: %s", self.name, e)
+            return lines
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                labels = labels if isinstance(labels, tuple) else (labels,)
+                lines.append(f"{self.name}{_labels(self.labelnames, labels)} {v}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+# ------------------------------------------------------------------ turno
+
+SPANS = Histogram(
+    "voicemenu_span_seconds",
+    "Duração de cada etapa do turno e dos efeitos colaterais.",
+    ("span",),
+)
+LLM_TOKENS = Counter("voicemenu_llm_tokens_total", "Tokens consumidos no LLM.", ("kind",))
+CALL_TOKENS = Histogram(
+    "voicemenu_call_tokens",
+    "Tokens por ligação, observados quando a ligação termina.",
+    ("kind",),
+    TOKEN_BUCKETS,
+)
+CALLS = Counter("voicemenu_calls_total", "Ligações atendidas pelo WebSocket.")
+TURNS = Counter("voicemenu_turns_total", "Turnos respondidos, por origem da resposta.", ("source",))
+TURNS_CANCELLED = Counter(
+    "voicemenu_turns_cancelled_total",
+    "Gerações abandonadas porque o cliente interrompeu ou falou de novo.",
+    ("reason",),
+)
+LLM_LATENCY = Histogram("voicemenu_llm_seconds", "Latência do LLM por modelo.", ("model", "phase"))
+MODEL_TURNS = Counter("voicemenu_model_turns_total", "Turnos por modelo e motivo da escolha.", ("model", "reason"))
+MODEL_ESCALATIONS = Counter(
+    "voicemenu_model_escalations_total",
+    "Respostas do modelo rápido reprovadas na validação e refeitas no forte.",
+    ("model",),
+)
+EVENT_LOOP_LAG = Histogram("voicemenu_event_loop_lag_seconds", "Atraso do event loop em relação ao agendado.")
+
+_active_calls = 0
+
+
+class span:
+    """`with span("prompt_build"):` — observa a duração em voicemenu_span_seconds."""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        SPANS.observe(time.perf_counter() - self.start, self.name)
+        return False
+
+
+def observe_span(name: str, seconds: float):
+    SPANS.observe(seconds, name)
+
+
+def call_started():
+    global _active_calls
+    _active_calls += 1
+    CALLS.inc()
+
+
+def call_ended(token_usage: dict | None):
+    global _active_calls
+    _active_calls -= 1
+    if token_usage:
+        for kind, value in token_usage.items():
+            CALL_TOKENS.observe(value, kind)
+
+
+def active_calls() -> int:
+    return _active_calls
+
+
+async def monitor_event_loop(interval: float):
+    """Dorme `interval` e mede quanto além disso o loop demorou para voltar."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(0.0, loop.time() - start - interval))
+
+
+# ---------------------------------------------------------------- profiler
+
+
+class SamplingProfiler:
+    """
+    Amostra a pilha da thread do event loop a cada `interval` segundos e
+    acumula no formato "folded" (uma pilha por linha, com contagem), que
+    flamegraph.pl e speedscope leem direto. Desligado por padrão.
+    """
+
+    def __init__(self, interval: float, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples: _Tally[str] = _Tally()
+        self._target = threading.get_ident()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+        logger.info("[Metrics] Profiler por amostragem ligado (%.0f Hz)", 1 / self.interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                code = frame.f_code
+                stack.append(f"{code.co_filename.rsplit('/', 1)[-1]}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def folded(self, reset: bool = False) -> str:
+        samples = self.samples
+        if reset:
+            self.samples = _Tally()
+        return "\n".join(f"{stack} {count}" for stack, count in samples.most_common()) + "\n"
+
+
+profiler: SamplingProfiler | None = (
+    SamplingProfiler(settings.profiler_interval) if settings.profiler_interval > 0 else None
+)
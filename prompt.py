@@ -0,0 +1,205 @@
+"""
+Prompt builder — prefixo de sistema estável (cacheável pelo provedor) e
+estado do pedido numa mensagem separada no fim.
+"""
+import logging
+from collections import OrderedDict
+from config import get_settings
+from menu import get_catalog
+from session import CallSession
+from logs import VERBOSE
+from metrics import LLM_TOKENS
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# Prefixos de versões anteriores do cardápio, para ligações que começaram antes do reload.
+_PREFIX_VERSIONS = 4
+
+
+SYSTEM_PROMPT_TEMPLATE = """
+Você é a Duda, assistente virtual de pedidos do {restaurant_name}.
+Você está atendendo um cliente por ligação telefônica.
+
+IDIOMA: Responda SEMPRE em português brasileiro, independente do idioma do cliente.
+Seja natural e conversacional — esta é uma ligação de voz, então nunca use markdown, listas ou símbolos. Use frases curtas e claras.
+
+SEU CARDÁPIO:
+{menu}
+
+SEU OBJETIVO:
+1. Pergunte o nome do cliente no início e use-o naturalmente durante a conversa.
+2. Anote o pedido do cliente, confirmando cada item.
+3. Após o pedido principal, ofereça UM upsell (ex: "Gostaria de adicionar uma bebida ou acompanhamento, [nome]?").
+4. Leia o pedido completo e o total para confirmação.
+5. Informe que enviará o link de pagamento por SMS.
+6. Após o pagamento confirmado (você será informada), faça na ordem:
+   a. Confirme o endereço de retirada e o tempo de preparo.
+   b. Pergunte se o cliente quer que você repita o endereço.
+   c. Se sim, repita o endereço com clareza.
+   d. Pergunte se o cliente anotou o endereço e o número do pedido.
+   e. Pergunte se pode ajudar com mais alguma coisa.
+   f. Agradeça pelo nome e se despeça com carinho.
+
+ENDEREÇO DO RESTAURANTE: {address}
+
+REGRAS IMPORTANTES:
+- Sempre confirme os itens pelo nome e preço.
+- Se o cliente não for claro, peça gentilmente uma confirmação.
+- Nunca invente itens ou preços. Use apenas itens do cardápio.
+- Respostas CURTAS — máximo 3 frases por turno.
+- Seja calorosa, natural e eficiente.
+- Use o nome do cliente de forma natural — não em toda frase, mas o suficiente para ser pessoal.
+- Nunca leia símbolos como R$ — diga "reais" (ex: "vinte e cinco reais e noventa centavos").
+- Nunca diga "item número", "ponto" ou use listas.
+- O estado atual do pedido vem sempre na última mensagem, marcado como ESTADO ATUAL DO PEDIDO.
+- Descrições dos itens relevantes para o turno vêm na última mensagem, em DETALHES DOS ITENS. Se o cliente perguntar de um item sem detalhes, diga só o nome e o preço.
+
+FORMATO DA RESPOSTA:
+Responda APENAS com JSON no formato:
+{{"speech": "O que você diz ao cliente", "action": "none", "ops": []}}
+
+- "ops" lista mudanças no pedido: {{"op": "add" | "remove" | "set", "id": "ID do cardápio", "qty": 1}}
+  "add" soma à quantidade, "set" define a quantidade final, "remove" tira o item (qty 0).
+- Use SOMENTE IDs do cardápio. Nunca repita nomes ou preços nas ops — o sistema resolve.
+- "action" = "update_order" quando o cliente confirma itens para adicionar, remover ou mudar
+- "action" = "confirm_order" quando o cliente confirma o pedido completo e está pronto para pagar
+- "action" = "send_payment" quando confirmou o pedido e está pronto para enviar o link
+- "action" = "end_call" após confirmar as instruções de retirada
+- Nos outros casos, "action" = "none" e "ops" = []
+- Escreva sempre o campo "speech" primeiro — ele é falado enquanto o resto da resposta é gerado.
+"""
+
+ORDER_STATE_TEMPLATE = "ESTADO ATUAL DO PEDIDO:\n{order_summary}"
+SUMMARY_TEMPLATE = "RESUMO DA CONVERSA ATÉ AGORA:\n{summary}"
+DETAILS_TEMPLATE = "DETALHES DOS ITENS:\n{details}"
+
+
+def _last_user_message(session: CallSession) -> str:
+    for message in reversed(session.conversation_history):
+        if message["role"] == "user":
+            return message["content"]
+    return ""
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 caracteres por token em PT-BR; suficiente para orçamento, não para cobrança.
+    return len(text) // 4 + 4
+
+
+def history_window(session: CallSession) -> tuple[int, int]:
+    """(início, fim) das mensagens que vão verbatim, antes do orçamento de tokens.
+    Mensagens anteriores à janela que ainda não foram resumidas continuam
+    entrando até o resumo em segundo plano alcançá-las."""
+    history = session.conversation_history
+    window_start = max(0, len(history) - 2 * settings.history_max_turns)
+    return min(session.summarized_upto, window_start), len(history)
+
+
+class PromptBuilder:
+    def __init__(self):
+        self._prefixes: OrderedDict[str, str] = OrderedDict()  # versão do cardápio -> prefixo
+        self.turns = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def system_prompt(self, session: CallSession | None = None) -> str:
+        """
+        Renderizado uma vez por versão do cardápio — byte a byte igual entre
+        turnos. Com `session`, usa a versão fixada na ligação (o warm_up fixa a
+        atual): um reload do menu no meio da chamada não troca o prefixo nem
+        perde o cache de prompt do provedor. Se a versão fixada já saiu da
+        memória (vários reloads, ou a ligação veio de outro worker), a ligação
+        passa para a atual.
+        """
+        catalog = get_catalog()
+        if catalog.version not in self._prefixes:
+            self._prefixes[catalog.version] = SYSTEM_PROMPT_TEMPLATE.format(
+                restaurant_name=catalog.restaurant["name"],
+                address=catalog.restaurant.get("address", ""),
+                menu=catalog.compact_text if settings.menu_retrieval_enabled else catalog.prompt_text,
+            )
+            while len(self._prefixes) > _PREFIX_VERSIONS:
+                self._prefixes.popitem(last=False)
+            logger.info("[Prompt] Prefixo renderizado para cardápio %s", catalog.version)
+
+        version = catalog.version
+        if session is not None:
+            if session.menu_version not in self._prefixes:
+                if session.menu_version is not None:
+                    logger.info(
+                        "[Prompt] Cardápio %s da ligação fora da memória; usando %s",
+                        session.menu_version, catalog.version,
+                    )
+                session.menu_version = catalog.version
+            version = session.menu_version
+        return self._prefixes[version]
+
+    def order_state_message(self, session: CallSession) -> dict:
+        summary = session.get_order_summary() if session.order_items else "Vazio — nenhum item ainda."
+        content = ORDER_STATE_TEMPLATE.format(order_summary=summary)
+        if settings.menu_retrieval_enabled:
+            details = get_catalog().relevant_details(
+                _last_user_message(session),
+                [item.item_id for item in session.order_items],
+                settings.menu_retrieval_limit,
+            )
+            if details:
+                content += "\n\n" + DETAILS_TEMPLATE.format(details=details)
+        return {"role": "system", "content": content}
+
+    def build_messages(self, session: CallSession) -> list[dict]:
+        head = [{"role": "system", "content": self.system_prompt(session)}]
+        if session.history_summary:
+            head.append({"role": "system", "content": SUMMARY_TEMPLATE.format(summary=session.history_summary)})
+        tail = [self.order_state_message(session)]
+
+        budget = settings.history_token_budget - sum(estimate_tokens(m["content"]) for m in head + tail)
+        start, end = history_window(session)
+        history = session.conversation_history[start:end]
+
+        # Corta do mais antigo, mas a última fala do cliente sempre vai.
+        used = sum(estimate_tokens(m["content"]) for m in history)
+        while len(history) > 1 and used > budget:
+            used -= estimate_tokens(history[0]["content"])
+            history = history[1:]
+
+        return head + history + tail
+
+    def record_usage(self, session: CallSession, usage) -> None:
+        if usage is None:
+            return
+        prompt_tokens = usage.prompt_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            cached = details.get("cached_tokens") or 0
+        else:
+            cached = getattr(details, "cached_tokens", 0) or 0
+
+        self.turns += 1
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached
+        session.token_usage["prompt"] += prompt_tokens
+        session.token_usage["cached"] += cached
+        session.token_usage["completion"] += usage.completion_tokens or 0
+        LLM_TOKENS.inc("prompt", amount=prompt_tokens)
+        LLM_TOKENS.inc("cached", amount=cached)
+        LLM_TOKENS.inc("completion", amount=usage.completion_tokens or 0)
+
+        logger.info(
+            "[Prompt] %s tokens de prompt (%s em cache, %s sem cache)",
+            prompt_tokens, cached, prompt_tokens - cached, extra=VERBOSE,
+        )
+
+    def stats(self) -> dict:
+        ratio = self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+        return {
+            "turns": self.turns,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "uncached_tokens": self.prompt_tokens - self.cached_tokens,
+            "cached_ratio": round(ratio, 4),
+        }
+
+
+prompt_builder = PromptBuilder()
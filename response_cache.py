@@ -0,0 +1,177 @@
+"""
+Cache de respostas informativas — endereço, tempo de preparo, o que vem em
+cada lanche, alergênicos. A mesma pergunta, no mesmo cardápio e na mesma
+fase da ligação, recebe a resposta que o LLM já deu antes, sem round-trip.
+
+Só entram turnos que não mexem no pedido, cuja pergunta nomeia o próprio
+assunto (item do cardápio ou tópico fixo) e cuja resposta não carrega nada
+da ligação (nome do cliente, número ou total do pedido).
+"""
+import re
+import time
+from collections import OrderedDict
+from config import get_settings
+from menu import get_catalog
+from menu_index import normalize
+from metrics import Counter
+from session import CallSession, CallState
+
+settings = get_settings()
+
+RESPONSE_CACHE = Counter("voicemenu_response_cache_total", "Consultas ao cache de respostas.", ("result",))
+
+_FILLERS = re.compile(
+    r"\b(?:ah+|ahn|eh+|hum+|hm+|uh+|entao|tipo|assim|ne|olha|oi|ola|moca|moco|"
+    r"por favor|me diz|me fala|me conta|sabe|e ai|bom|bem|so uma duvida|uma duvida|"
+    r"deixa eu perguntar|queria saber|gostaria de saber|voce sabe)\b"
+)
+# Artigos e "é" soltos não mudam a pergunta: "qual é o endereço" = "qual o endereço".
+_GLUE = re.compile(r"\b(?:e|o|a|os|as)\b")
+_QUESTION_CUES = (
+    "qual", "quais", "onde", "quanto", "quando", "como", "o que", "que horas",
+    "tem ", "voces tem", "e vegano", "vem com", "leva", "aceita", "fica",
+)
+# A pergunta precisa nomear o próprio assunto: um item/categoria do cardápio
+# ou um destes tópicos fixos. "Quanto custa?" ou "é vegano?" dependem do turno
+# anterior e a resposta de uma ligação seria sobre outro item na seguinte.
+_TOPICS = re.compile(
+    r"\b(?:endereco|onde (?:fica|voces ficam)|localizacao|horario\w*|que horas|abre|fecha|aberto|"
+    r"funciona\w*|tempo de preparo|quanto tempo|demora\w*|alergen\w*|alergi\w*|"
+    r"forma\w* de pagamento|pix|cartao|dinheiro)\b"
+)
+# Atributos que aparecem em nomes ("Maionese Vegana") mas sozinhos não nomeiam item.
+_ATTRIBUTES = re.compile(r"\b(?:vegan[oa]s?|vegetarian[oa]s?|picante|apimentad[oa]|gluten|lactose|zero|light|diet)\b")
+_ANAPHORA = {
+    "esse", "essa", "esses", "essas", "este", "esta", "estes", "estas", "isso", "isto",
+    "ele", "ela", "eles", "elas", "dele", "dela", "deles", "delas", "nele", "nela",
+    "desse", "dessa", "disso", "deste", "desta", "nesse", "nessa", "aquele", "aquela", "aquilo",
+    "mesmo", "mesma",
+}
+# Perguntas sobre o próprio pedido ou conta não servem para outra ligação.
+_PERSONAL_CUES = ("meu ", "minha ", "meus ", "minhas ", "pedido", "total", "conta", "eu pedi", "comprei")
+_CAPITALIZED = re.compile(r"\b[A-ZÀ-Ý][\wÀ-ÿ]+")
+
+_STATE_GROUPS = {
+    CallState.GREETING: "start",
+    CallState.DETECTING_LANGUAGE: "start",
+    CallState.TAKING_ORDER: "ordering",
+    CallState.UPSELL: "ordering",
+    CallState.CONFIRMING_ORDER: "ordering",
+    CallState.PAYMENT_SENT: "payment",
+    CallState.PAYMENT_CONFIRMED: "after",
+    CallState.DONE: "after",
+}
+
+
+def normalize_question(transcript: str) -> str:
+    return " ".join(_GLUE.sub(" ", _FILLERS.sub(" ", normalize(transcript))).split())
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: OrderedDict[tuple, tuple[float, str]] = OrderedDict()
+        self._version: str | None = None
+        self._vocabulary: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, session: CallSession, question: str) -> tuple:
+        return (self._version, _STATE_GROUPS.get(session.state, "other"), question)
+
+    def _sync_menu(self):
+        catalog = get_catalog()
+        if catalog.version != self._version:
+            # Cardápio novo: respostas sobre itens e preços podem ter mudado.
+            self._entries.clear()
+            self._version = catalog.version
+            words = [catalog.restaurant["name"], catalog.restaurant.get("address", "")]
+            words.append(catalog.restaurant.get("agent", {}).get("name", ""))
+            words += [item.get("name_pt", "") for item in catalog.items.values()]
+            words += list(catalog.categories)
+            self._vocabulary = set(normalize(" ".join(words)).split())
+
+    def get(self, session: CallSession, transcript: str) -> str | None:
+        if not settings.response_cache_enabled:
+            return None
+        self._sync_menu()
+        if not self._self_contained(normalize(transcript)):
+            return None
+        key = self._key(session, normalize_question(transcript))
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            RESPONSE_CACHE.inc("miss")
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        RESPONSE_CACHE.inc("hit")
+        return entry[1]
+
+    def put(self, session: CallSession, transcript: str, result: dict):
+        if not settings.response_cache_enabled:
+            return
+        if not self._cacheable(session, transcript, result):
+            RESPONSE_CACHE.inc("skipped")
+            return
+        key = self._key(session, normalize_question(transcript))
+        self._entries[key] = (time.monotonic() + self.ttl, result["speech"])
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        RESPONSE_CACHE.inc("stored")
+
+    def _cacheable(self, session: CallSession, transcript: str, result: dict) -> bool:
+        if result.get("action", "none") != "none" or result.get("ops"):
+            return False
+        text = normalize(transcript)
+        padded = f" {text} "
+        if "?" not in transcript and not any(cue in padded for cue in _QUESTION_CUES):
+            return False
+        if any(cue in padded for cue in _PERSONAL_CUES):
+            return False
+        self._sync_menu()
+        if not self._self_contained(text):
+            return False
+        speech = result.get("speech") or ""
+        if not speech or session.order_id in speech or re.search(r"\d{4,}", speech):
+            return False
+        return not self._mentions_caller(session, speech)
+
+    def _self_contained(self, text: str) -> bool:
+        """`text` já normalizado. Referência a turno anterior nunca entra."""
+        if _ANAPHORA.intersection(text.split()):
+            return False
+        if _TOPICS.search(text):
+            return True
+        subject = _ATTRIBUTES.sub(" ", text)
+        return bool(get_catalog().index.search(subject, limit=1, descriptions=False))
+
+    def _mentions_caller(self, session: CallSession, speech: str) -> bool:
+        """Nome próprio na resposta que o cliente disse na ligação e não é do cardápio — provavelmente o nome dele."""
+        said = set()
+        for message in session.conversation_history:
+            if message["role"] == "user":
+                said.update(normalize(message["content"]).split())
+        if session.customer_name:
+            said.update(normalize(session.customer_name).split())
+        for word in _CAPITALIZED.findall(speech):
+            token = normalize(word)
+            if token in said and token not in self._vocabulary:
+                return True
+        return False
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+response_cache = ResponseCache(settings.response_cache_size, settings.response_cache_ttl)
@@ -1,11 +1,22 @@
 """
-In-memory session store for active calls.
-For production, replace with Redis.
+Session store for active calls.
+In-memory by default; Redis (SESSION_STORE=redis) when running several workers.
 """
+from abc import ABC, abstractmethod
 from typing import Optional
+from collections import OrderedDict
 from enum import Enum
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
 import uuid
 from datetime import datetime
+from config import get_settings
+
+logger = logging.getLogger(__name__)
 
 
 class CallState(str, Enum):
@@ -19,7 +30,13 @@ class CallState(str, Enum):
     DONE = "done"
 
 
+def _cents(value: float) -> int:
+    return int(round(value * 100))
+
+
 class OrderItem:
+    __slots__ = ("item_id", "name", "quantity", "unit_price")
+
     def __init__(self, item_id: str, name: str, quantity: int, unit_price: float):
         self.item_id = item_id
         self.name = name
@@ -39,8 +56,23 @@ class OrderItem:
             "total": self.total,
         }
 
+    def to_compact(self) -> list:
+        return [self.item_id, self.name, self.quantity, self.unit_price]
+
+    @classmethod
+    def from_compact(cls, data: list) -> "OrderItem":
+        return cls(*data)
+
 
 class CallSession:
+    __slots__ = (
+        "call_sid", "from_number", "order_id", "state", "language",
+        "conversation_history", "order_items", "payment_link",
+        "payment_intent_id", "payment_confirmed", "created_at",
+        "customer_name", "token_usage", "last_activity", "_total_cents",
+        "history_summary", "summarized_upto", "menu_version",
+    )
+
     def __init__(self, call_sid: str, from_number: str):
         self.call_sid = call_sid
         self.from_number = from_number  # Customer phone number
@@ -54,10 +86,60 @@ class CallSession:
         self.payment_confirmed = False
         self.created_at = datetime.now()
         self.customer_name: Optional[str] = None
+        self.token_usage = {"prompt": 0, "cached": 0, "completion": 0}
+        self.last_activity = time.monotonic()
+        self._total_cents = 0
+        self.history_summary = ""
+        self.summarized_upto = 0  # mensagens de conversation_history já resumidas
+        self.menu_version: Optional[str] = None  # cardápio do prefixo do prompt, fixado no warm_up
 
     @property
     def order_total(self) -> float:
-        return sum(item.total for item in self.order_items)
+        return self._total_cents / 100
+
+    def find_item(self, item_id: str) -> Optional[OrderItem]:
+        return next((i for i in self.order_items if i.item_id == item_id), None)
+
+    def add_item(self, item_id: str, name: str, quantity: int, unit_price: float) -> OrderItem:
+        item = self.find_item(item_id)
+        if item:
+            item.quantity += quantity
+        else:
+            item = OrderItem(item_id, name, quantity, unit_price)
+            self.order_items.append(item)
+        self._total_cents += quantity * _cents(item.unit_price)
+        return item
+
+    def set_item_quantity(self, item_id: str, quantity: int):
+        item = self.find_item(item_id)
+        if item is None:
+            return
+        if quantity <= 0:
+            self.remove_item(item_id)
+            return
+        self._total_cents += (quantity - item.quantity) * _cents(item.unit_price)
+        item.quantity = quantity
+
+    def remove_item(self, item_id: str):
+        item = self.find_item(item_id)
+        if item is None:
+            return
+        self.order_items.remove(item)
+        self._total_cents -= item.quantity * _cents(item.unit_price)
+
+    def _recalculate_total(self):
+        self._total_cents = sum(i.quantity * _cents(i.unit_price) for i in self.order_items)
+
+    def order_fingerprint(self) -> str:
+        """Hash estável dos itens do pedido — muda sempre que o pedido muda."""
+        key = "|".join(
+            f"{i.item_id}:{i.quantity}:{_cents(i.unit_price)}"
+            for i in sorted(self.order_items, key=lambda i: i.item_id)
+        )
+        return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+    def touch(self):
+        self.last_activity = time.monotonic()
 
     def add_message(self, role: str, content: str):
         self.conversation_history.append({"role": role, "content": content})
@@ -71,27 +153,380 @@ class CallSession:
         lines.append(f"\n  Total: R$ {self.order_total:.2f}")
         return "\n".join(lines)
 
+    def to_compact(self) -> str:
+        return json.dumps({
+            "c": self.call_sid,
+            "f": self.from_number,
+            "o": self.order_id,
+            "s": self.state.value,
+            "l": self.language,
+            "h": self.conversation_history,
+            "i": [item.to_compact() for item in self.order_items],
+            "pl": self.payment_link,
+            "pi": self.payment_intent_id,
+            "pc": self.payment_confirmed,
+            "t": self.created_at.timestamp(),
+            "n": self.customer_name,
+            "u": self.token_usage,
+            "hs": self.history_summary,
+            "hu": self.summarized_upto,
+            "mv": self.menu_version,
+        }, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_compact(cls, raw: str | bytes) -> "CallSession":
+        data = json.loads(raw)
+        session = cls(data["c"], data["f"])
+        session.order_id = data["o"]
+        session.state = CallState(data["s"])
+        session.language = data["l"]
+        session.conversation_history = data["h"]
+        session.order_items = [OrderItem.from_compact(i) for i in data["i"]]
+        session._recalculate_total()
+        session.payment_link = data["pl"]
+        session.payment_intent_id = data["pi"]
+        session.payment_confirmed = data["pc"]
+        session.created_at = datetime.fromtimestamp(data["t"])
+        session.customer_name = data["n"]
+        session.token_usage = data["u"]
+        session.history_summary = data.get("hs", "")
+        session.summarized_upto = data.get("hu", 0)
+        session.menu_version = data.get("mv")
+        return session
+
+
+class SessionStore(ABC):
+    @abstractmethod
+    async def get(self, call_sid: str) -> Optional[CallSession]: ...
+
+    @abstractmethod
+    async def save(self, session: CallSession) -> None: ...
+
+    @abstractmethod
+    async def delete(self, call_sid: str) -> None: ...
+
+    @abstractmethod
+    async def find_by_payment_intent(self, payment_intent_id: str) -> Optional[CallSession]: ...
+
+    @abstractmethod
+    async def find_by_order_id(self, order_id: str) -> Optional[CallSession]: ...
+
+    @abstractmethod
+    async def mark_payment_confirmed(self, call_sid: str, payment_intent_id: Optional[str] = None) -> Optional[CallSession]:
+        """Marca o pagamento sem sobrescrever o resto da sessão, que pode
+        estar sendo alterada por outro worker no mesmo instante."""
+
+    async def listen(self) -> None:
+        """Recebe confirmações de pagamento feitas por outros workers."""
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """Ordenado por uso (LRU). Acima de max_sessions, as mais antigas são
+    arquivadas e removidas — menos as que esperam o webhook de pagamento."""
+
+    def __init__(self, max_sessions: int = 0, archive: Optional["SessionArchive"] = None):
+        self._sessions: OrderedDict[str, CallSession] = OrderedDict()
+        self._by_payment_intent: dict[str, str] = {}
+        self._by_order_id: dict[str, str] = {}
+        self.max_sessions = max_sessions
+        self.archive = archive
+
+    async def get(self, call_sid: str) -> Optional[CallSession]:
+        session = self._sessions.get(call_sid)
+        if session is not None:
+            self._sessions.move_to_end(call_sid)
+        return session
+
+    async def save(self, session: CallSession) -> None:
+        session.touch()
+        self._sessions[session.call_sid] = session
+        self._sessions.move_to_end(session.call_sid)
+        self._by_order_id[session.order_id] = session.call_sid
+        if session.payment_intent_id:
+            self._by_payment_intent[session.payment_intent_id] = session.call_sid
+        if self.max_sessions and len(self._sessions) > self.max_sessions:
+            await self._enforce_limit()
+
+    async def _enforce_limit(self):
+        excess = len(self._sessions) - self.max_sessions
+        # Link enviado e pagamento pendente: removê-la perderia o pagamento.
+        candidates = [
+            call_sid for call_sid, session in self._sessions.items()
+            if not (session.payment_link and not session.payment_confirmed)
+        ][:excess]
+        for call_sid in candidates:
+            logger.warning("[Session] Limite de %s sessões atingido, removendo %s", self.max_sessions, call_sid)
+            await self.evict(call_sid)
+
+    async def evict(self, call_sid: str) -> bool:
+        """Arquiva e só então remove. False se o arquivo falhou (a sessão fica)."""
+        session = self._sessions.get(call_sid)
+        if session is None:
+            return True
+        if self.archive:
+            last_activity = session.last_activity
+            if not await self.archive.write(session):
+                return False
+            if session.last_activity != last_activity:
+                # Voltou a ser usada enquanto o arquivo era gravado.
+                return False
+        await self.delete(call_sid)
+        return True
+
+    def expired(self, idle_ttl: float) -> list[str]:
+        now = time.monotonic()
+        return [
+            call_sid for call_sid, session in self._sessions.items()
+            if session.state == CallState.DONE or now - session.last_activity > idle_ttl
+        ]
+
+    async def delete(self, call_sid: str) -> None:
+        session = self._sessions.pop(call_sid, None)
+        if session is None:
+            return
+        self._by_order_id.pop(session.order_id, None)
+        if session.payment_intent_id:
+            self._by_payment_intent.pop(session.payment_intent_id, None)
+
+    async def find_by_payment_intent(self, payment_intent_id: str) -> Optional[CallSession]:
+        call_sid = self._by_payment_intent.get(payment_intent_id)
+        return self._sessions.get(call_sid) if call_sid else None
+
+    async def find_by_order_id(self, order_id: str) -> Optional[CallSession]:
+        call_sid = self._by_order_id.get(order_id)
+        return self._sessions.get(call_sid) if call_sid else None
+
+    async def mark_payment_confirmed(self, call_sid: str, payment_intent_id: Optional[str] = None) -> Optional[CallSession]:
+        session = self._sessions.get(call_sid)
+        if session is None:
+            return None
+        session.payment_confirmed = True
+        if payment_intent_id and not session.payment_intent_id:
+            session.payment_intent_id = payment_intent_id
+        await self.save(session)
+        notify_payment_confirmed(call_sid)
+        return session
+
+    def __len__(self) -> int:
+        return len(self._sessions)
 
-# Global in-memory store: call_sid -> CallSession
-_sessions: dict[str, CallSession] = {}
 
+class RedisSessionStore(SessionStore):
+    """
+    Sessões serializadas em formato compacto, com TTL por chave e índices
+    secundários (payment_intent_id, order_id) apontando para o call_sid.
+    Funciona com qualquer servidor que fale o protocolo Redis; `client`
+    aceita um cliente já pronto (ex: fakeredis nos testes).
+    """
 
-def create_session(call_sid: str, from_number: str) -> CallSession:
+    def __init__(self, url: str, ttl_seconds: int, prefix: str = "voicemenu:", client=None):
+        if client is None:
+            try:
+                import redis.asyncio as redis
+            except ImportError:
+                raise RuntimeError("SESSION_STORE=redis requer o pacote redis instalado.")
+            client = redis.from_url(url)
+        self._redis = client
+        self.ttl = ttl_seconds
+        self.prefix = prefix
+
+    def _key(self, kind: str, value: str) -> str:
+        return f"{self.prefix}{kind}:{value}"
+
+    async def get(self, call_sid: str) -> Optional[CallSession]:
+        raw, paid = await self._redis.mget(self._key("s", call_sid), self._key("paid", call_sid))
+        if raw is None:
+            return None
+        session = CallSession.from_compact(raw)
+        if paid is not None:
+            session.payment_confirmed = True
+            session.payment_intent_id = session.payment_intent_id or paid.decode() or None
+        return session
+
+    async def save(self, session: CallSession) -> None:
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.set(self._key("s", session.call_sid), session.to_compact(), ex=self.ttl)
+        pipe.set(self._key("oid", session.order_id), session.call_sid, ex=self.ttl)
+        if session.payment_intent_id:
+            pipe.set(self._key("pi", session.payment_intent_id), session.call_sid, ex=self.ttl)
+        await pipe.execute()
+
+    async def delete(self, call_sid: str) -> None:
+        session = await self.get(call_sid)
+        if session is None:
+            return
+        keys = [
+            self._key("s", call_sid),
+            self._key("paid", call_sid),
+            self._key("oid", session.order_id),
+        ]
+        if session.payment_intent_id:
+            keys.append(self._key("pi", session.payment_intent_id))
+        await self._redis.delete(*keys)
+
+    async def _find_by(self, kind: str, value: str) -> Optional[CallSession]:
+        call_sid = await self._redis.get(self._key(kind, value))
+        return await self.get(call_sid.decode()) if call_sid else None
+
+    async def find_by_payment_intent(self, payment_intent_id: str) -> Optional[CallSession]:
+        return await self._find_by("pi", payment_intent_id)
+
+    async def find_by_order_id(self, order_id: str) -> Optional[CallSession]:
+        return await self._find_by("oid", order_id)
+
+    async def mark_payment_confirmed(self, call_sid: str, payment_intent_id: Optional[str] = None) -> Optional[CallSession]:
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.set(self._key("paid", call_sid), payment_intent_id or "", ex=self.ttl)
+        if payment_intent_id:
+            pipe.set(self._key("pi", payment_intent_id), call_sid, ex=self.ttl)
+        pipe.publish(self._key("events", "paid"), call_sid)
+        await pipe.execute()
+        return await self.get(call_sid)
+
+    async def listen(self) -> None:
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(self._key("events", "paid"))
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        notify_payment_confirmed(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("[Session] Pub/sub do Redis caiu, reconectando: %s", e)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def close(self) -> None:
+        await self._redis.aclose()
+
+
+# Esperas de pagamento deste processo: call_sid -> future resolvido pelo webhook
+_payment_waiters: dict[str, asyncio.Future] = {}
+
+
+def notify_payment_confirmed(call_sid: str):
+    waiter = _payment_waiters.get(call_sid)
+    if waiter and not waiter.done():
+        waiter.set_result(True)
+
+
+def pending_payment_waits() -> int:
+    return len(_payment_waiters)
+
+
+async def wait_for_payment(call_sid: str, timeout: float) -> bool:
+    """
+    Espera o webhook confirmar o pagamento. Retorna False no timeout; se a
+    task for cancelada (WebSocket caiu), a espera é removida sem deixar rastro.
+    """
+    waiter = asyncio.get_running_loop().create_future()
+    _payment_waiters[call_sid] = waiter
+    try:
+        # O webhook pode ter chegado antes de a espera existir.
+        session = await get_session(call_sid)
+        if session and session.payment_confirmed:
+            return True
+        return await asyncio.wait_for(waiter, timeout)
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        if _payment_waiters.get(call_sid) is waiter:
+            del _payment_waiters[call_sid]
+
+
+class SessionArchive:
+    """Arquivo append-only (JSONL por dia) das sessões removidas da memória."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    async def write(self, session: CallSession) -> bool:
+        try:
+            await asyncio.to_thread(self._write_sync, session.to_compact())
+            return True
+        except OSError as e:
+            logger.error("[Session] Erro ao arquivar sessão %s: %s", session.call_sid, e)
+            return False
+
+    def _write_sync(self, line: str):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"sessions-{datetime.now():%Y%m%d}.jsonl")
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+
+
+async def sweep_sessions():
+    """Remove sessões DONE ou ociosas além do TTL. O Redis expira sozinho."""
+    settings = get_settings()
+    store = get_store()
+    if not isinstance(store, InMemorySessionStore):
+        return
+    while True:
+        await asyncio.sleep(settings.session_sweep_interval)
+        try:
+            evicted = 0
+            for call_sid in store.expired(settings.session_idle_ttl_seconds):
+                evicted += await store.evict(call_sid)
+            if evicted:
+                logger.info("[Session] %s sessões arquivadas, %s ativas", evicted, len(store))
+        except Exception as e:
+            logger.error("[Session] Erro no sweeper: %s", e)
+
+
+_store: Optional[SessionStore] = None
+
+
+def get_store() -> SessionStore:
+    global _store
+    if _store is None:
+        settings = get_settings()
+        if settings.session_store == "redis":
+            _store = RedisSessionStore(settings.redis_url, settings.session_ttl_seconds)
+            logger.info("[Session] Usando Redis em %s", settings.redis_url)
+        else:
+            if settings.web_concurrency > 1:
+                # /incoming, /ws e o webhook da mesma ligação caem em processos
+                # diferentes, e cada um só vê as próprias sessões.
+                raise RuntimeError(
+                    f"SESSION_STORE=memory não funciona com WEB_CONCURRENCY={settings.web_concurrency}; "
+                    "use SESSION_STORE=redis ou um worker só."
+                )
+            archive = SessionArchive(settings.session_archive_dir) if settings.session_archive_dir else None
+            _store = InMemorySessionStore(settings.session_max_sessions, archive)
+    return _store
+
+
+async def create_session(call_sid: str, from_number: str) -> CallSession:
     session = CallSession(call_sid, from_number)
-    _sessions[call_sid] = session
+    await get_store().save(session)
     return session
 
 
-def get_session(call_sid: str) -> Optional[CallSession]:
-    return _sessions.get(call_sid)
+async def get_session(call_sid: str) -> Optional[CallSession]:
+    return await get_store().get(call_sid)
+
+
+async def save_session(session: CallSession):
+    await get_store().save(session)
+
+
+async def delete_session(call_sid: str):
+    await get_store().delete(call_sid)
+
+
+async def get_session_by_payment_intent(payment_intent_id: str) -> Optional[CallSession]:
+    return await get_store().find_by_payment_intent(payment_intent_id)
 
 
-def delete_session(call_sid: str):
-    _sessions.pop(call_sid, None)
+async def get_session_by_order_id(order_id: str) -> Optional[CallSession]:
+    return await get_store().find_by_order_id(order_id)
 
 
-def get_session_by_payment_intent(payment_intent_id: str) -> Optional[CallSession]:
-    for session in _sessions.values():
-        if session.payment_intent_id == payment_intent_id:
-            return session
-    return None
+async def mark_payment_confirmed(call_sid: str, payment_intent_id: Optional[str] = None) -> Optional[CallSession]:
+    return await get_store().mark_payment_confirmed(call_sid, payment_intent_id)
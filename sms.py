@@ -1,40 +1,254 @@
 """
 SMS handler — envia link de pagamento e confirmação por SMS.
+
+Os envios entram numa fila limitada e são feitos por workers com um único
+cliente HTTP (keep-alive) para a API REST da Twilio, com retry e backoff.
+Quem chama só enfileira — nada aqui bloqueia o turno da ligação.
 """
-from twilio.rest import Client
-from config import get_settings
-from menu import get_restaurant_info
+import asyncio
 import logging
+import random
+import uuid
+from collections import OrderedDict
+import httpx
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import Response
+from twilio.request_validator import RequestValidator
+from config import get_settings
+from menu import get_catalog
+from logs import VERBOSE
+from metrics import Counter, span
 
 logger = logging.getLogger(__name__)
+router = APIRouter(prefix="/sms", tags=["sms"])
 settings = get_settings()
 
+SMS_RESULTS = Counter("voicemenu_sms_total", "SMS por resultado final.", ("status",))
+
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+_FINAL_STATUS = {"delivered", "undelivered", "failed"}
+
+
+class SmsTemplates:
+    """Textos com os dados do restaurante já aplicados; só faltam os do pedido."""
+
+    def __init__(self, restaurant: dict):
+        name = restaurant["name"]
+        address = restaurant.get("address", "nosso restaurante")
+        prep_time = restaurant.get("prep_time_minutes", 15)
+        self.payment = (
+            f"🍔 {name}\n"
+            "Pedido #{order_id}\n"
+            "Total: R$ {total:.2f}\n\n"
+            "Clique para pagar:\n"
+            "{payment_link}\n\n"
+            "Após o pagamento, aguarde a confirmação na ligação."
+        )
+        self.confirmation = (
+            f"✅ {name}\n"
+            "Pagamento confirmado!\n"
+            "Pedido #{order_id} — R$ {total:.2f}\n\n"
+            f"Pronto em aprox. {prep_time} min.\n"
+            f"Retire em: {address}"
+        )
+
+
+class SmsMessage:
+    __slots__ = ("key", "to", "body", "attempts", "status", "sid", "error")
+
+    def __init__(self, key: str, to: str, body: str):
+        self.key = key
+        self.to = to
+        self.body = body
+        self.attempts = 0
+        self.status = "queued"
+        self.sid: str | None = None
+        self.error: str | None = None
+
+    def to_dict(self) -> dict:
+        return {
+            "key": self.key,
+            "to": self.to,
+            "status": self.status,
+            "sid": self.sid,
+            "attempts": self.attempts,
+            "error": self.error,
+        }
+
+
+class SmsDispatcher:
+    def __init__(self, workers: int, queue_size: int, max_retries: int, history_size: int = 1000):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.max_retries = max_retries
+        self.history_size = history_size
+        self._queue: asyncio.Queue[SmsMessage] | None = None
+        self._client: httpx.AsyncClient | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._messages: OrderedDict[str, SmsMessage] = OrderedDict()
+        self._by_sid: dict[str, str] = {}
+        self._templates: SmsTemplates | None = None
+        self._templates_version: str | None = None
+
+    @property
+    def url(self) -> str:
+        return f"{settings.twilio_api_base}/2010-04-01/Accounts/{settings.twilio_account_sid}/Messages.json"
+
+    def templates(self) -> SmsTemplates:
+        catalog = get_catalog()
+        if catalog.version != self._templates_version:
+            self._templates = SmsTemplates(catalog.restaurant)
+            self._templates_version = catalog.version
+        return self._templates
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._client = httpx.AsyncClient(
+            auth=(settings.twilio_account_sid, settings.twilio_auth_token),
+            timeout=settings.sms_timeout,
+            limits=httpx.Limits(max_connections=self.workers, max_keepalive_connections=self.workers),
+        )
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 5.0):
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("[SMS] %s mensagens não enviadas no shutdown", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._client is not None:
+            await self._client.aclose()
+
+    def enqueue(self, to: str, body: str) -> str | None:
+        if self._queue is None:
+            logger.error("[SMS] Dispatcher não iniciado; SMS para %s descartado", to)
+            return None
+        message = SmsMessage(uuid.uuid4().hex[:12], to, body)
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            logger.error("[SMS] Fila cheia (%s); SMS para %s descartado", self.queue_size, to)
+            SMS_RESULTS.inc("dropped")
+            return None
+        self._track(message)
+        return message.key
 
-async def send_payment_sms(
+    def _track(self, message: SmsMessage):
+        self._messages[message.key] = message
+        while len(self._messages) > self.history_size:
+            _, old = self._messages.popitem(last=False)
+            if old.sid:
+                self._by_sid.pop(old.sid, None)
+
+    def status(self, key: str) -> dict | None:
+        message = self._messages.get(key)
+        return message.to_dict() if message else None
+
+    def update_status(self, sid: str, status: str):
+        key = self._by_sid.get(sid)
+        if key and key in self._messages:
+            self._messages[key].status = status
+            if status in _FINAL_STATUS and status != "delivered":
+                logger.warning("[SMS] Mensagem %s não entregue: %s", sid, status)
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def _worker(self):
+        while True:
+            message = await self._queue.get()
+            try:
+                await self._deliver(message)
+            except Exception as e:
+                # Resposta 2xx sem JSON, DecodingError, TooManyRedirects...: a
+                # mensagem falha, o worker continua.
+                message.status = "failed"
+                message.error = repr(e)
+                SMS_RESULTS.inc("failed")
+                logger.error("[SMS] Erro inesperado ao enviar para %s: %r", message.to, e)
+            finally:
+                self._queue.task_done()
+
+    async def _deliver(self, message: SmsMessage):
+        data = {
+            "To": message.to,
+            "From": settings.twilio_phone_number,
+            "Body": message.body,
+        }
+        if settings.base_url:
+            data["StatusCallback"] = f"{settings.base_url}/sms/status"
+
+        while True:
+            message.attempts += 1
+            message.status = "sending"
+            retryable = False
+            try:
+                with span("sms_send"):
+                    response = await self._client.post(self.url, data=data)
+                if response.status_code < 300:
+                    message.sid = response.json().get("sid")
+                    message.status = "sent"
+                    if message.sid:
+                        self._by_sid[message.sid] = message.key
+                    logger.info("SMS enviado para %s, SID: %s", message.to, message.sid, extra=VERBOSE)
+                    SMS_RESULTS.inc("sent")
+                    return
+                retryable = response.status_code in _RETRY_STATUS
+                message.error = f"HTTP {response.status_code}: {response.text[:200]}"
+            except httpx.TransportError as e:
+                retryable = True
+                message.error = str(e)
+
+            if not retryable or message.attempts > self.max_retries:
+                message.status = "failed"
+                SMS_RESULTS.inc("failed")
+                logger.error("[SMS] Falha ao enviar para %s após %s tentativas: %s", message.to, message.attempts, message.error)
+                return
+
+            delay = settings.sms_retry_backoff * (2 ** (message.attempts - 1))
+            await asyncio.sleep(delay + random.uniform(0, delay / 2))
+
+
+dispatcher = SmsDispatcher(
+    workers=settings.sms_workers,
+    queue_size=settings.sms_queue_size,
+    max_retries=settings.sms_max_retries,
+)
+
+
+def send_payment_sms(
     to_number: str,
     order_id: str,
     payment_link: str,
     total: float,
     language: str = "pt",
-):
-    client = Client(settings.twilio_account_sid, settings.twilio_auth_token)
-    restaurant = get_restaurant_info()
-    restaurant_name = restaurant["name"]
-
-    message_body = (
-        f"🍔 {restaurant_name}\n"
-        f"Pedido #{order_id}\n"
-        f"Total: R$ {total:.2f}\n\n"
-        f"Clique para pagar:\n"
-        f"{payment_link}\n\n"
-        f"Após o pagamento, aguarde a confirmação na ligação."
+) -> str | None:
+    body = dispatcher.templates().payment.format(
+        order_id=order_id, total=total, payment_link=payment_link,
     )
+    return dispatcher.enqueue(to_number, body)
+
+
+def send_confirmation_sms(to_number: str, order_id: str, total: float) -> str | None:
+    """Enviado mesmo se a ligação cair."""
+    body = dispatcher.templates().confirmation.format(order_id=order_id, total=total)
+    return dispatcher.enqueue(to_number, body)
+
+
+_validator = RequestValidator(settings.twilio_auth_token)
 
-    message = client.messages.create(
-        body=message_body,
-        from_=settings.twilio_phone_number,
-        to=to_number,
-    )
 
-    logger.info(f"SMS enviado para {to_number}, SID: {message.sid}")
-    return message.sid
+@router.post("/status")
+async def sms_status_callback(request: Request):
+    # Mesma URL que foi passada como StatusCallback em _deliver.
+    form = dict(await request.form())
+    url = f"{settings.base_url}/sms/status"
+    if not _validator.validate(url, form, request.headers.get("X-Twilio-Signature", "")):
+        raise HTTPException(status_code=403, detail="Assinatura inválida")
+    if "MessageSid" not in form or "MessageStatus" not in form:
+        raise HTTPException(status_code=422, detail="MessageSid e MessageStatus são obrigatórios")
+    dispatcher.update_status(form["MessageSid"], form["MessageStatus"])
+    return Response(status_code=204)
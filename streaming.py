@@ -0,0 +1,151 @@
+"""
+Parser incremental de JSON — extrai o campo "speech" da resposta do modelo
+enquanto ela ainda está sendo gerada, para falar antes do JSON terminar.
+"""
+
+_ESCAPES = {
+    '"': '"',
+    "\\": "\\",
+    "/": "/",
+    "b": "\b",
+    "f": "\f",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+}
+
+_SENTENCE_END = ".!?;:"
+_SOFT_BREAK = ","
+_SOFT_BREAK_MIN_CHARS = 24
+
+
+class SpeechExtractor:
+    """Recebe pedaços do JSON bruto e devolve o texto novo do campo alvo."""
+
+    def __init__(self, field: str = "speech"):
+        self.field = field
+        self.raw = ""
+        self.done = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._unicode: str | None = None
+        self._high_surrogate: int | None = None
+        self._string_buf: list[str] = []
+        self._expect_key = False
+        self._last_key: str | None = None
+        self._capturing = False
+
+    def feed(self, chunk: str) -> str:
+        self.raw += chunk
+        out = []
+        for ch in chunk:
+            if self._in_string:
+                text = self._consume_string_char(ch)
+                if text and self._capturing:
+                    out.append(text)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_buf = []
+                self._capturing = (
+                    self._depth == 1
+                    and not self._expect_key
+                    and self._last_key == self.field
+                    and not self.done
+                )
+            elif ch in "{[":
+                self._depth += 1
+                self._expect_key = ch == "{"
+            elif ch in "}]":
+                self._depth -= 1
+            elif ch == "," and self._depth == 1:
+                self._expect_key = True
+            elif ch == ":":
+                self._expect_key = False
+        return "".join(out)
+
+    def _consume_string_char(self, ch: str) -> str:
+        if self._unicode is not None:
+            self._unicode += ch
+            if len(self._unicode) < 4:
+                return ""
+            try:
+                code = int(self._unicode, 16)
+            except ValueError:
+                code = None
+            self._unicode = None
+            return self._append_code(code)
+
+        if self._escape:
+            self._escape = False
+            if ch == "u":
+                self._unicode = ""
+                return ""
+            self._high_surrogate = None
+            return self._append(_ESCAPES.get(ch, ch))
+
+        if ch == "\\":
+            self._escape = True
+            return ""
+
+        # Surrogate alto sem o par (\uD83D seguido de outra coisa): descarta.
+        self._high_surrogate = None
+
+        if ch == '"':
+            self._in_string = False
+            if self._depth == 1 and self._expect_key:
+                self._last_key = "".join(self._string_buf)
+            elif self._capturing:
+                self._capturing = False
+                self.done = True
+            return ""
+
+        return self._append(ch)
+
+    def _append_code(self, code: int | None) -> str:
+        """Emojis chegam como par \\uD83D\\uDE00: segura o alto até vir o baixo."""
+        high, self._high_surrogate = self._high_surrogate, None
+        if code is None:
+            return ""
+        if 0xD800 <= code <= 0xDBFF:
+            self._high_surrogate = code
+            return ""
+        if 0xDC00 <= code <= 0xDFFF:
+            if high is None:
+                return ""
+            code = 0x10000 + ((high - 0xD800) << 10) + (code - 0xDC00)
+        return self._append(chr(code))
+
+    def _append(self, text: str) -> str:
+        self._string_buf.append(text)
+        return text
+
+
+class PhraseChunker:
+    """Agrupa tokens em frases curtas para o TTS do ConversationRelay."""
+
+    def __init__(self, min_soft_chars: int = _SOFT_BREAK_MIN_CHARS):
+        self.min_soft_chars = min_soft_chars
+        self._buf = ""
+
+    def push(self, text: str) -> list[str]:
+        self._buf += text
+        phrases = []
+        start = 0
+        for i, ch in enumerate(self._buf):
+            at_boundary = i + 1 < len(self._buf) and self._buf[i + 1].isspace()
+            if not at_boundary:
+                continue
+            if ch in _SENTENCE_END or (
+                ch in _SOFT_BREAK and i + 1 - start >= self.min_soft_chars
+            ):
+                phrases.append(self._buf[start:i + 2])
+                start = i + 2
+        self._buf = self._buf[start:]
+        return phrases
+
+    def flush(self) -> str:
+        rest, self._buf = self._buf, ""
+        return rest
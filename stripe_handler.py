@@ -4,30 +4,63 @@ Stripe payment handler — PT-BR.
 import stripe
 import asyncio
 import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import Response
 from config import get_settings
+from comanda import print_comanda
+from session import CallState, get_session, mark_payment_confirmed, save_session
+from sms import send_confirmation_sms
+from journal import journal, session_from_order
+from logs import VERBOSE, bind_call
+from metrics import span
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/payment", tags=["payment"])
 settings = get_settings()
 
 stripe.api_key = settings.stripe_secret_key
+if settings.stripe_api_base:
+    stripe.api_base = settings.stripe_api_base
+stripe.max_network_retries = settings.stripe_max_retries
+stripe.default_http_client = stripe.RequestsClient(timeout=settings.stripe_timeout)
 
+# A SDK da Stripe é síncrona: toda chamada roda neste pool, nunca no event loop.
+_stripe_pool = ThreadPoolExecutor(
+    max_workers=settings.stripe_max_workers, thread_name_prefix="stripe"
+)
 
-async def create_payment_link(session) -> tuple[str, str]:
+
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _run_stripe(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await asyncio.wait_for(
+        loop.run_in_executor(_stripe_pool, partial(fn, *args, **kwargs)),
+        settings.stripe_timeout * (settings.stripe_max_retries + 1),
+    )
+
+
+def _payment_link_params(session, generation: int) -> dict:
     line_items = []
     for item in session.order_items:
         line_items.append({
             "price_data": {
                 "currency": settings.stripe_currency,
                 "product_data": {"name": item.name},
-                "unit_amount": int(item.unit_price * 100),
+                "unit_amount": int(round(item.unit_price * 100)),
             },
             "quantity": item.quantity,
         })
 
-    payment_link = stripe.PaymentLink.create(
+    return dict(
+        idempotency_key=f"paylink-{session.order_id}-{session.order_fingerprint()}-{generation}",
         line_items=line_items,
         metadata={
             "order_id": session.order_id,
@@ -42,35 +75,327 @@ async def create_payment_link(session) -> tuple[str, str]:
         },
     )
 
-    return payment_link.url, payment_link.id
 
+class PaymentLinkPrefetcher:
+    """
+    Cria o link de pagamento em segundo plano assim que o pedido é
+    confirmado, amarrado ao fingerprint dos itens. Se o pedido mudar, o link
+    antigo é desativado na Stripe e outro é criado.
+    """
 
-async def _send_confirmation_sms(phone: str, order_id: str, total: float):
-    """Envia SMS de confirmação mesmo se a ligação cair."""
-    try:
-        from menu import get_restaurant_info
-        from twilio.rest import Client
-        restaurant = get_restaurant_info()
-        address = restaurant.get("address", "nosso restaurante")
-        prep_time = restaurant.get("prep_time_minutes", 15)
-        client = Client(settings.twilio_account_sid, settings.twilio_auth_token)
-
-        message = (
-            f"✅ {restaurant['name']}\n"
-            f"Pagamento confirmado!\n"
-            f"Pedido #{order_id} — R$ {total:.2f}\n\n"
-            f"Pronto em aprox. {prep_time} min.\n"
-            f"Retire em: {address}"
-        )
+    def __init__(self):
+        self._links: dict[str, tuple[str, asyncio.Task]] = {}
+        self._generation: dict[str, int] = {}
 
-        client.messages.create(
-            body=message,
-            from_=settings.twilio_phone_number,
-            to=phone,
-        )
-        logger.info(f"SMS de confirmação enviado para {phone}, pedido {order_id}")
+    def prefetch(self, session):
+        fingerprint = session.order_fingerprint()
+        entry = self._links.get(session.call_sid)
+        if entry and entry[0] == fingerprint:
+            return
+        self.invalidate(session.call_sid)
+        if not session.order_items:
+            return
+        # Parâmetros montados agora: a task não pode ver o pedido mudar depois.
+        params = _payment_link_params(session, self._generation.get(session.call_sid, 0))
+        task = asyncio.create_task(_run_stripe(stripe.PaymentLink.create, **params))
+        task.add_done_callback(_log_prefetch_failure)
+        self._links[session.call_sid] = (fingerprint, task)
+        logger.info("[Stripe] Link de pagamento antecipado para %s (%s)", session.call_sid, fingerprint)
+
+    def sync(self, session):
+        """Chamado a cada turno: antecipa em CONFIRMING_ORDER, invalida se o pedido mudou."""
+        if session.state == CallState.CONFIRMING_ORDER:
+            self.prefetch(session)
+            return
+        entry = self._links.get(session.call_sid)
+        if entry and entry[0] != session.order_fingerprint():
+            self.invalidate(session.call_sid)
+
+    async def get(self, session) -> tuple[str, str]:
+        entry = self._links.pop(session.call_sid, None)
+        if entry and entry[0] == session.order_fingerprint():
+            try:
+                payment_link = await entry[1]
+                return payment_link.url, payment_link.id
+            except Exception as e:
+                logger.warning("[Stripe] Link antecipado falhou, criando de novo: %s", e)
+                self._bump(session.call_sid)
+        elif entry:
+            self._discard(session.call_sid, entry)
+
+        params = _payment_link_params(session, self._generation.get(session.call_sid, 0))
+        payment_link = await _run_stripe(stripe.PaymentLink.create, **params)
+        return payment_link.url, payment_link.id
+
+    def invalidate(self, call_sid: str):
+        entry = self._links.pop(call_sid, None)
+        if entry is not None:
+            self._discard(call_sid, entry)
+
+    def _discard(self, call_sid: str, entry: tuple[str, asyncio.Task]):
+        self._bump(call_sid)
+        entry[1].add_done_callback(_deactivate_link)
+
+    def forget(self, call_sid: str):
+        """Fim da ligação: links antecipados que nunca foram enviados são desativados."""
+        self.invalidate(call_sid)
+        self._generation.pop(call_sid, None)
+
+    def _bump(self, call_sid: str):
+        self._generation[call_sid] = self._generation.get(call_sid, 0) + 1
+
+
+def _log_prefetch_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.warning("[Stripe] Falha ao antecipar link de pagamento: %s", task.exception())
+
+
+def _spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _deactivate_link(task: asyncio.Task):
+    if task.cancelled() or task.exception():
+        return
+    _spawn(_deactivate(task.result().id))
+
+
+async def _deactivate(link_id: str):
+    try:
+        await _run_stripe(stripe.PaymentLink.modify, link_id, active=False)
+        logger.info("[Stripe] Link %s desativado (pedido mudou)", link_id)
     except Exception as e:
-        logger.error(f"Erro ao enviar SMS de confirmação: {e}")
+        logger.error("[Stripe] Erro ao desativar link %s: %s", link_id, e)
+
+
+payment_links = PaymentLinkPrefetcher()
+
+
+async def create_payment_link(session) -> tuple[str, str]:
+    with span("stripe_link"):
+        return await payment_links.get(session)
+
+
+class EventDedup:
+    """
+    IDs já vistos: LRU em memória (caminho rápido do webhook) e, se
+    configurado, uma tabela SQLite que sobrevive a restarts. A tabela também
+    guarda os pedidos já aplicados, para o efeito ser único por pedido.
+    """
+
+    def __init__(self, size: int, db_path: str = "", ttl: float = 7 * 86400):
+        self.size = size
+        self.ttl = ttl
+        self._recent: OrderedDict[str, None] = OrderedDict()
+        self._db: sqlite3.Connection | None = None
+        self._db_lock = threading.Lock()
+        self._pruned_at = 0.0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS stripe_dedup (key TEXT PRIMARY KEY, created_at REAL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS stripe_dedup_created ON stripe_dedup (created_at)"
+            )
+            self._db.commit()
+
+    def seen_recently(self, key: str) -> bool:
+        """Marca e diz se já estava na LRU. Só memória — seguro no event loop."""
+        if key in self._recent:
+            self._recent.move_to_end(key)
+            return True
+        self._recent[key] = None
+        while len(self._recent) > self.size:
+            self._recent.popitem(last=False)
+        return False
+
+    def forget(self, key: str):
+        self._recent.pop(key, None)
+
+    def claim(self, key: str) -> bool:
+        """True se esta é a primeira vez (persistente). Bloqueante: rodar fora do loop."""
+        if self._db is None:
+            return True
+        now = time.time()
+        with self._db_lock:
+            if now - self._pruned_at > 3600:
+                # Passada a janela de reenvio da Stripe a chave não protege mais nada.
+                self._db.execute("DELETE FROM stripe_dedup WHERE created_at < ?", (now - self.ttl,))
+                self._pruned_at = now
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO stripe_dedup (key, created_at) VALUES (?, ?)",
+                (key, now),
+            )
+            self._db.commit()
+            return cursor.rowcount == 1
+
+    def release(self, key: str):
+        """Desfaz um claim cujo efeito falhou, para a próxima tentativa aplicar. Bloqueante."""
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute("DELETE FROM stripe_dedup WHERE key = ?", (key,))
+            self._db.commit()
+
+
+class WebhookProcessor:
+    """
+    Fila de eventos já verificados, aplicada por um pool de workers. A Stripe
+    já recebeu 200, então um evento que falha não volta sozinho: as chaves de
+    dedup são liberadas e o evento volta para a fila com backoff.
+    """
+
+    def __init__(self, workers: int, queue_size: int, dedup: EventDedup, max_attempts: int = 5):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.dedup = dedup
+        self.max_attempts = max_attempts
+        self._queue: asyncio.Queue | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._applied_calls: OrderedDict[str, None] = OrderedDict()
+        self._attempts: dict[str, int] = {}
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 5.0):
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("[Stripe] %s eventos pendentes no shutdown", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def submit(self, event) -> bool:
+        if self._queue is None:
+            return False
+        try:
+            self._queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def _worker(self):
+        while True:
+            event = await self._queue.get()
+            bind_call(None)
+            key = f"evt:{event['id']}"
+            claimed = False
+            try:
+                claimed = await asyncio.to_thread(self.dedup.claim, key)
+                if claimed:
+                    await self._handle(event)
+                    self._attempts.pop(event["id"], None)
+            except Exception as e:
+                if claimed:
+                    await self._release(key)
+                self._retry(event, e)
+            finally:
+                self._queue.task_done()
+
+    async def _release(self, key: str):
+        try:
+            await asyncio.to_thread(self.dedup.release, key)
+        except Exception as e:
+            logger.error("[Stripe] Erro ao liberar %s: %s", key, e)
+
+    def _retry(self, event, error: Exception):
+        attempt = self._attempts.get(event["id"], 0) + 1
+        if attempt >= self.max_attempts:
+            self._attempts.pop(event["id"], None)
+            # Um reenvio manual pelo dashboard da Stripe ainda passa pelo dedup.
+            self.dedup.forget(event["id"])
+            logger.error("[Stripe] Evento %s abandonado após %s tentativas: %s", event["id"], attempt, error)
+            return
+        self._attempts[event["id"]] = attempt
+        logger.warning("[Stripe] Erro ao processar evento %s (tentativa %s): %s", event["id"], attempt, error)
+        _spawn(self._resubmit(event, min(2 ** attempt, 60)))
+
+    async def _resubmit(self, event, delay: float):
+        await asyncio.sleep(delay)
+        if not self.submit(event):
+            self._retry(event, RuntimeError("fila de eventos cheia"))
+
+    async def _handle(self, event):
+        if event["type"] not in ("checkout.session.completed", "payment_intent.succeeded"):
+            return
+        obj = event["data"]["object"]
+        metadata = obj.get("metadata", {}) or {}
+        call_sid = metadata.get("call_sid")
+        if not call_sid:
+            return
+        payment_intent_id = obj["id"] if event["type"] == "payment_intent.succeeded" else None
+        await self._apply_payment(call_sid, metadata.get("customer_phone"), payment_intent_id)
+
+    async def _apply_payment(self, call_sid: str, customer_phone: str | None, payment_intent_id: str | None):
+        """checkout.session.completed e payment_intent.succeeded chegam para o
+        mesmo pedido; só o primeiro imprime e manda SMS. A marcação em memória
+        acontece antes de qualquer await, então workers concorrentes não correm.
+        Se algo falha antes da confirmação, a marcação e o claim são desfeitos."""
+
+        if call_sid in self._applied_calls:
+            return
+        self._remember(call_sid)
+
+        order_key = None
+        try:
+            session = await get_session(call_sid) or await _restore_from_journal(call_sid)
+            if session is None:
+                raise LookupError(f"pagamento para ligação desconhecida {call_sid}")
+            order_id = session.order_id
+            bind_call(call_sid, order_id)
+            if not await asyncio.to_thread(self.dedup.claim, f"order:{order_id}"):
+                return
+            order_key = f"order:{order_id}"
+
+            session = await mark_payment_confirmed(call_sid, payment_intent_id)
+            if session is None:
+                raise LookupError(f"sessão {call_sid} sumiu antes da confirmação")
+        except Exception:
+            self._applied_calls.pop(call_sid, None)
+            if order_key:
+                await self._release(order_key)
+            raise
+
+        journal.payment_confirmed(session, payment_intent_id)
+        logger.info("Pagamento confirmado: pedido %s, ligação %s", order_id, call_sid)
+        _spawn(print_comanda(session))
+        send_confirmation_sms(customer_phone or session.from_number, order_id, session.order_total)
+
+    def _remember(self, call_sid: str):
+        self._applied_calls[call_sid] = None
+        while len(self._applied_calls) > self.dedup.size:
+            self._applied_calls.popitem(last=False)
+
+
+async def _restore_from_journal(call_sid: str):
+    """Sessão já saiu do store (restart, eviction): o pedido volta do diário."""
+    order = await asyncio.to_thread(journal.order_for_call, call_sid)
+    if order is None:
+        return None
+    session = session_from_order(order)
+    await save_session(session)
+    logger.info("[Stripe] Pedido %s da ligação %s restaurado do diário", session.order_id, call_sid)
+    return session
+
+
+webhook_processor = WebhookProcessor(
+    workers=settings.stripe_webhook_workers,
+    queue_size=settings.stripe_webhook_queue_size,
+    dedup=EventDedup(settings.stripe_dedup_size, settings.stripe_dedup_db, settings.stripe_dedup_ttl_seconds),
+    max_attempts=settings.stripe_webhook_max_attempts,
+)
 
 
 @router.post("/webhook")
@@ -79,44 +404,21 @@ async def stripe_webhook(request: Request):
     sig_header = request.headers.get("stripe-signature")
 
     try:
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, settings.stripe_webhook_secret
+        event = await _run_stripe(
+            stripe.Webhook.construct_event,
+            payload, sig_header, settings.stripe_webhook_secret,
         )
-    except stripe.error.SignatureVerificationError:
+    except (stripe.error.SignatureVerificationError, ValueError):
         raise HTTPException(status_code=400, detail="Assinatura inválida")
 
-    logger.info(f"Stripe event: {event['type']}")
+    logger.info("Stripe event: %s (%s)", event["type"], event["id"], extra=VERBOSE)
 
-    if event["type"] == "checkout.session.completed":
-        stripe_session = event["data"]["object"]
-        metadata = stripe_session.get("metadata", {})
-        call_sid = metadata.get("call_sid")
-        order_id = metadata.get("order_id")
-        customer_phone = metadata.get("customer_phone")
-
-        if call_sid:
-            from session import get_session
-            from comanda import print_comanda
-            session = get_session(call_sid)
-            if session:
-                session.payment_confirmed = True
-                total = session.order_total
-                logger.info(f"Pagamento confirmado: pedido {order_id}, ligação {call_sid}")
-                asyncio.create_task(print_comanda(session))
-                asyncio.create_task(_send_confirmation_sms(customer_phone, order_id, total))
-
-    elif event["type"] == "payment_intent.succeeded":
-        payment_intent = event["data"]["object"]
-        metadata = payment_intent.get("metadata", {})
-        call_sid = metadata.get("call_sid")
+    if webhook_processor.dedup.seen_recently(event["id"]):
+        return Response(status_code=200)
 
-        if call_sid:
-            from session import get_session
-            from comanda import print_comanda
-            session = get_session(call_sid)
-            if session and not session.payment_confirmed:
-                session.payment_confirmed = True
-                session.payment_intent_id = payment_intent["id"]
-                asyncio.create_task(print_comanda(session))
+    if not webhook_processor.submit(event):
+        # Sem espaço na fila: a Stripe tenta de novo mais tarde.
+        webhook_processor.dedup.forget(event["id"])
+        raise HTTPException(status_code=503, detail="Fila de eventos cheia")
 
     return Response(status_code=200)
@@ -0,0 +1,11 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Settings são lidos uma vez, no primeiro import: caminhos absolutos para
+# os testes rodarem de qualquer diretório e sem escrever no repositório.
+os.environ.setdefault("MENU_PATH", os.path.join(ROOT, "menu.json"))
+os.environ.setdefault("JOURNAL_PATH", "")
+os.environ.setdefault("SESSION_ARCHIVE_DIR", "")
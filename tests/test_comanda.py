@@ -0,0 +1,107 @@
+"""
+Golden bytes da comanda: o buffer de render_comanda_bytes, escrito num
+escpos Dummy como faz o spool, tem que bater byte a byte com o arquivo
+em tests/data. Se a mudança no ticket for intencional, regenere com
+`UPDATE_GOLDEN=1 python -m pytest tests/test_comanda.py`.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+from escpos.printer import Dummy
+
+import comanda
+from session import CallSession
+
+GOLDEN = os.path.join(os.path.dirname(__file__), "data", "comanda.bin")
+FROZEN = datetime(2024, 5, 17, 19, 42, 5)
+
+
+class _FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return FROZEN
+
+
+def _session() -> CallSession:
+    session = CallSession("CA-golden", "+5511999990000")
+    session.order_id = "A1B2C3D4"
+    session.add_item("BURGER-001", "Filthy Onion", 2, 39.9)
+    session.add_item("SIDE-001", "Big Filthy Fries", 1, 24.5)
+    session.add_item("DRINK-004", "Guaraná Antarctica 350ml", 3, 7.0)
+    return session
+
+
+def _printed(monkeypatch, **kwargs) -> bytes:
+    monkeypatch.setattr(comanda, "datetime", _FrozenDatetime)
+    printer = Dummy()
+    printer._raw(comanda.render_comanda_bytes(_session(), **kwargs))
+    return printer.output
+
+
+def test_render_matches_golden_bytes(monkeypatch):
+    output = _printed(monkeypatch)
+    if os.environ.get("UPDATE_GOLDEN"):
+        with open(GOLDEN, "wb") as f:
+            f.write(output)
+    with open(GOLDEN, "rb") as f:
+        assert output == f.read()
+
+
+def test_station_ticket_lists_only_its_items(monkeypatch):
+    session = _session()
+    output = _printed(monkeypatch, items=session.order_items[:1], station="grill")
+    assert "Estação: GRILL".encode("cp850") in output
+    assert b"2x Filthy Onion" in output
+    assert b"Big Filthy Fries" not in output
+
+
+
+def test_spool_reports_failure_then_prints(monkeypatch, tmp_path):
+    attempts = []
+
+    class FlakyPrinter(Dummy):
+        def _raw(self, msg):
+            attempts.append(msg)
+            if len(attempts) == 1:
+                raise OSError("sem papel")
+            super()._raw(msg)
+
+    monkeypatch.setattr(comanda, "_open_printer", lambda config: FlakyPrinter())
+    monkeypatch.setattr(comanda.time, "sleep", lambda seconds: None)
+    events, printed = [], threading.Event()
+    spool = comanda.PrinterSpool(
+        "grill", {"type": "dummy"}, str(tmp_path),
+        on_printed=lambda order_id, station: (events.append(("printed", order_id, station)), printed.set()),
+        on_failed=lambda order_id, station: events.append(("failed", order_id, station)),
+    )
+    spool.start()
+    try:
+        path = spool.submit("A1B2C3D4", b"ticket")
+        assert printed.wait(5)
+    finally:
+        spool.stop()
+    assert events == [("failed", "A1B2C3D4", "grill"), ("printed", "A1B2C3D4", "grill")]
+    assert attempts == [b"ticket", b"ticket"]
+    assert not os.path.exists(path)
+
+
+def test_spool_quarantines_unreadable_tickets(monkeypatch, tmp_path):
+    monkeypatch.setattr(comanda.settings, "print_spool_scan_interval", 0.01)
+    spool = comanda.PrinterSpool("default", {"type": "dummy"}, str(tmp_path))
+    spool.start()
+    try:
+        bad = os.path.join(spool.directory, "sem-timestamp.bin")
+        with open(bad, "wb") as f:
+            f.write(b"ticket")
+        quarantined = os.path.join(spool.directory, "failed", "sem-timestamp.bin")
+        for _ in range(500):
+            if os.path.exists(quarantined):
+                break
+            time.sleep(0.01)
+    finally:
+        spool.stop()
+    assert os.path.exists(quarantined)
+    assert not os.path.exists(bad)
+    assert bad not in spool._known
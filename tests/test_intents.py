@@ -0,0 +1,20 @@
+from intents import classifier
+from session import CallSession, CallState
+
+
+def _confirming(last_assistant: str) -> CallSession:
+    session = CallSession("CA-intents", "+5511999990000")
+    session.add_item("BURGER-001", "Filthy Onion", 1, 39.9)
+    session.state = CallState.CONFIRMING_ORDER
+    session.add_message("assistant", last_assistant)
+    return session
+
+
+def test_yes_to_payment_offer_sends_link():
+    session = _confirming("Seu pedido ficou um Filthy Onion. Posso enviar o link de pagamento?")
+    assert classifier.classify(session, "sim, pode mandar")["action"] == "send_payment"
+
+
+def test_yes_to_upsell_goes_to_the_model():
+    session = _confirming("Quer adicionar uma batata para acompanhar?")
+    assert classifier.classify(session, "sim") is None
@@ -0,0 +1,12 @@
+from menu import get_catalog
+
+
+def test_asr_misspellings_find_the_item():
+    index = get_catalog().index
+    assert index.search("uma koka zéro")[0] == "DRINK-002"
+    assert index.search("guaca filti")[0] == "BURGER-004"
+
+
+def test_short_words_do_not_match_phonetically():
+    # "ser" e "zero" têm o mesmo esqueleto consonantal ("sr").
+    assert get_catalog().index.search("pode ser") == []
@@ -0,0 +1,41 @@
+import copy
+
+import prompt
+from menu import MenuCatalog, get_catalog
+from prompt import PromptBuilder
+from session import CallSession
+
+
+def _reloaded(name: str) -> MenuCatalog:
+    data = copy.deepcopy(get_catalog().data)
+    data["restaurant"]["name"] = name
+    return MenuCatalog(data, f"v-{name}")
+
+
+def test_call_keeps_its_menu_prefix_across_reloads(monkeypatch):
+    builder = PromptBuilder()
+    session = CallSession("CA-prompt", "+5511999990000")
+    session.add_message("user", "oi")
+    before = builder.build_messages(session)[0]["content"]
+    pinned = session.menu_version
+    assert pinned == get_catalog().version
+
+    monkeypatch.setattr(prompt, "get_catalog", lambda: _reloaded("Nova Casa"))
+    assert builder.build_messages(session)[0]["content"] == before
+    assert session.menu_version == pinned
+
+    other = CallSession("CA-prompt-2", "+5511999990001")
+    assert "Nova Casa" in builder.system_prompt(other)
+    assert other.menu_version == "v-Nova Casa"
+
+
+def test_evicted_version_moves_the_call_to_the_current_menu(monkeypatch):
+    builder = PromptBuilder()
+    session = CallSession("CA-prompt", "+5511999990000")
+    builder.system_prompt(session)
+    for i in range(prompt._PREFIX_VERSIONS):
+        monkeypatch.setattr(prompt, "get_catalog", lambda i=i: _reloaded(f"Casa {i}"))
+        builder.system_prompt()
+    last = f"Casa {prompt._PREFIX_VERSIONS - 1}"
+    assert last in builder.system_prompt(session)
+    assert session.menu_version == f"v-{last}"
@@ -0,0 +1,80 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+
+from session import CallSession, CallState, InMemorySessionStore, RedisSessionStore, SessionStore
+
+
+def _session() -> CallSession:
+    session = CallSession("CA-redis", "+5511999990000")
+    session.state = CallState.PAYMENT_SENT
+    session.customer_name = "Ana"
+    session.add_message("user", "quero um filthy onion")
+    session.add_message("assistant", "Anotado!")
+    session.add_item("BURGER-001", "Filthy Onion", 2, 39.9)
+    session.add_item("DRINK-004", "Guaraná Antarctica 350ml", 1, 7.0)
+    session.payment_link = "https://buy.stripe.com/test"
+    session.payment_intent_id = "plink_123"
+    session.token_usage = {"prompt": 1200, "cached": 800, "completion": 90}
+    session.history_summary = "Cliente pediu lanche."
+    session.summarized_upto = 1
+    session.menu_version = "abc123def456"
+    return session
+
+
+def _fields(session: CallSession) -> dict:
+    return {
+        slot: getattr(session, slot) for slot in CallSession.__slots__
+        if slot not in ("order_items", "last_activity")
+    } | {"order_items": [i.to_dict() for i in session.order_items]}
+
+
+def test_compact_round_trip():
+    session = _session()
+    restored = CallSession.from_compact(session.to_compact())
+    assert _fields(restored) == _fields(session)
+    assert restored.order_total == pytest.approx(86.8)
+
+
+def test_session_store_is_abstract():
+    with pytest.raises(TypeError):
+        SessionStore()
+
+
+def test_redis_store_round_trip_and_indexes():
+    async def scenario():
+        store = RedisSessionStore("", ttl_seconds=60, client=fakeredis.aioredis.FakeRedis())
+        session = _session()
+        await store.save(session)
+
+        assert _fields(await store.get(session.call_sid)) == _fields(session)
+        assert (await store.find_by_payment_intent("plink_123")).call_sid == session.call_sid
+        assert (await store.find_by_order_id(session.order_id)).call_sid == session.call_sid
+
+        paid = await store.mark_payment_confirmed(session.call_sid, "pi_456")
+        assert paid.payment_confirmed
+        assert paid.payment_intent_id == "plink_123"  # já tinha um; não sobrescreve
+        assert (await store.find_by_payment_intent("pi_456")).call_sid == session.call_sid
+
+        await store.delete(session.call_sid)
+        assert await store.get(session.call_sid) is None
+        assert await store.find_by_order_id(session.order_id) is None
+        assert await store.find_by_payment_intent("plink_123") is None
+        await store.close()
+
+    asyncio.run(scenario())
+
+
+def test_memory_store_indexes():
+    async def scenario():
+        store = InMemorySessionStore()
+        session = _session()
+        await store.save(session)
+        assert await store.find_by_payment_intent("plink_123") is session
+        assert await store.find_by_order_id(session.order_id) is session
+        assert (await store.mark_payment_confirmed(session.call_sid)).payment_confirmed
+        await store.delete(session.call_sid)
+        assert await store.find_by_order_id(session.order_id) is None
+
+    asyncio.run(scenario())
@@ -0,0 +1,59 @@
+import json
+
+from streaming import PhraseChunker, SpeechExtractor
+
+
+def _feed_by_char(raw: str, field: str = "speech") -> str:
+    extractor = SpeechExtractor(field)
+    return "".join(extractor.feed(ch) for ch in raw)
+
+
+def test_extracts_speech_with_escapes_split_across_chunks():
+    raw = json.dumps({"speech": 'Diga "oi"\nagora é \\ já', "action": "none"}, ensure_ascii=True)
+    assert _feed_by_char(raw) == 'Diga "oi"\nagora é \\ já'
+
+
+def test_unicode_escapes_including_surrogate_pairs():
+    speech = "Pão de queijo \U0001F600 e café ☕"
+    raw = json.dumps({"speech": speech}, ensure_ascii=True)
+    assert "\\ud83d\\ude00" in raw
+    assert _feed_by_char(raw) == speech
+
+    extractor = SpeechExtractor()
+    assert extractor.feed('{"speech": "a\\uD83D') == "a"
+    assert extractor.feed("\\uDE00b") == "\U0001F600b"
+
+
+def test_lone_surrogates_are_dropped():
+    assert _feed_by_char('{"speech": "a\\uD83Db\\uDE00c"}') == "abc"
+
+
+def test_speech_key_arriving_late():
+    raw = json.dumps({
+        "action": "add_item",
+        "items": [{"speech": "não é este", "qty": 1}],
+        "note": "speech",
+        "speech": "Anotado!",
+    })
+    extractor = SpeechExtractor()
+    out = "".join(extractor.feed(raw[i:i + 7]) for i in range(0, len(raw), 7))
+    assert out == "Anotado!"
+    assert extractor.done
+
+
+def test_phrase_chunker_breaks_on_sentence_end_and_long_commas():
+    chunker = PhraseChunker(min_soft_chars=10)
+    assert chunker.push("Oi! Tudo") == ["Oi! "]
+    assert chunker.push(" bem, ok") == []
+    assert chunker.push(", vamos lá com o pedido, certo") == ["Tudo bem, ok, ", "vamos lá com o pedido, "]
+    assert chunker.push("? Sim.") == ["certo? "]
+    assert chunker.flush() == "Sim."
+    assert chunker.flush() == ""
+
+
+def test_phrase_chunker_waits_for_the_space_after_punctuation():
+    chunker = PhraseChunker()
+    assert chunker.push("R$ 39.") == []
+    assert chunker.push("90 no total.") == []
+    assert chunker.push(" Confirma?") == ["R$ 39.90 no total. "]
+    assert chunker.flush() == "Confirma?"